@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# benchmark.py
+# Timing of the inference routines in inference.py on generated tracks.
+# Usage: python benchmark.py [--tracks=<n>] [--steps=<n>]
+import sys
+import time
+import tracemalloc
+
+import inference
+
+
+def time_it(f, *args):
+    # returns the wall-clock time of f(*args) in seconds
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_viterbi(num_tracks, num_time_steps):
+    # decodes the same fleet of tracks one at a time with Viterbi() and in
+    # one go with viterbi_batch(), and reports tracks/second for both
+    model = inference.getModel()
+    tracks = [inference.generate_data(num_time_steps, True, seed)[1]
+              for seed in range(num_tracks)]
+
+    single = time_it(lambda: [inference.Viterbi(o, model) for o in tracks])
+    batched = time_it(inference.viterbi_batch, tracks, None, model)
+
+    print("Viterbi, %d tracks of %d steps:" % (num_tracks, num_time_steps))
+    print("  one track at a time: %8.1f tracks/s" % (num_tracks / single))
+    print("  viterbi_batch:       %8.1f tracks/s" % (num_tracks / batched))
+
+
+def benchmark_scoring(num_tracks, num_time_steps):
+    # log-likelihood of every track, one at a time and with score_batch()
+    model = inference.getModel()
+    tracks = [inference.generate_data(num_time_steps, True, seed)[1]
+              for seed in range(num_tracks)]
+
+    single = time_it(lambda: [inference.log_likelihood(o, model)
+                              for o in tracks])
+    batched = time_it(inference.score_batch, tracks, None, model)
+
+    print("Scoring, %d tracks of %d steps:" % (num_tracks, num_time_steps))
+    print("  one track at a time: %8.1f tracks/s" % (num_tracks / single))
+    print("  score_batch:         %8.1f tracks/s" % (num_tracks / batched))
+
+
+def benchmark_simulation(num_tracks, num_time_steps):
+    # steps/second of generate_data() against the vectorized simulate()
+    model = inference.getModel()
+    few = max(1, num_tracks // 20)
+    single = time_it(lambda: [inference.generate_data(num_time_steps, True)
+                              for _ in range(few)])
+    batched = time_it(inference.simulate, num_tracks, num_time_steps, .1, 0,
+                      model)
+
+    print("Simulation, tracks of %d steps:" % num_time_steps)
+    print("  generate_data: %12.0f steps/s"
+          % (few * num_time_steps / single))
+    print("  simulate:      %12.0f steps/s"
+          % (num_tracks * num_time_steps / batched))
+
+
+def benchmark_messages(num_tracks, num_time_steps):
+    # forward and backward passes over every track, with a fresh workspace
+    # per call and with one shared MessageWorkspace; reports the time and
+    # the peak memory allocated while the passes run (traced by tracemalloc,
+    # which sees NumPy's buffers). Once the shared workspace has grown to
+    # the track length the peak should stay flat, independent of N and T.
+    model = inference.getModel()
+    tracks = [inference.generate_data(num_time_steps, True, seed)[1]
+              for seed in range(num_tracks)]
+    workspace = inference.MessageWorkspace(model.N)
+
+    def run(ws):
+        for o in tracks:
+            inference.calcForwardMessages(o, model, True, ws)
+            inference.calcBackwardMessages(o, model, ws)
+
+    run(workspace)  # warm up: grows the buffers, builds lazy tables
+    print("Message passing, %d tracks of %d steps:"
+          % (num_tracks, num_time_steps))
+    for name, ws in [("fresh buffers:   ", None),
+                     ("shared workspace:", workspace)]:
+        seconds = time_it(run, ws)
+        # tracing slows everything down, so memory is measured separately
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        run(ws)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        print("  %s %8.1f tracks/s, peak allocation %10d bytes"
+              % (name, num_tracks / seconds, peak))
+
+
+def main():
+    num_tracks = 200
+    num_time_steps = 100
+
+    for arg in sys.argv[1:]:
+        if arg.startswith('--tracks='):
+            num_tracks = int(arg[9:])
+        elif arg.startswith('--steps='):
+            num_time_steps = int(arg[8:])
+
+    benchmark_viterbi(num_tracks, num_time_steps)
+    benchmark_scoring(num_tracks, num_time_steps)
+    benchmark_simulation(num_tracks, num_time_steps)
+    benchmark_messages(num_tracks, num_time_steps)
+
+
+if __name__ == '__main__':
+    main()
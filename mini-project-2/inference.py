@@ -2,7 +2,10 @@
 # inference.py
 # Base code by George H. Chen (georgehc@mit.edu) -- updated 10/18/2016
 import collections
+import concurrent.futures
+import os
 import sys
+from multiprocessing import shared_memory
 
 import graphics
 import numpy as np
@@ -25,10 +28,15 @@ transition_model = robot.transition_model
 observation_model = robot.observation_model
 
 class ValToIndex:
+    # thin wrapper around a robot.StateIndex (built from a list of values,
+    # or passed in directly), so that a model and the ArrayDistributions it
+    # hands out share a single vocabulary
     def __init__( self, a  ):
-        self.sDict = dict()    
-        for idx, v in enumerate(a ):
-            self.sDict[v] = idx
+        if not isinstance(a, robot.StateIndex):
+            a = robot.StateIndex(a)
+        self.vocabulary = a
+        self.values = a.keys
+        self.sDict = a.index
         
     def vToIndex( self, v ):
         return self.sDict[v]
@@ -71,6 +79,612 @@ class EmissionMatrx:
         return self.B
     
 
+class SparseTransitionMatrix:
+    # Banded neighbor-index form of the transition matrix. The robot can only
+    # move to at most K = 5 successors, so instead of a dense N x N array we
+    # keep, for every state, the indices and probabilities of its successors
+    # and of its predecessors (padded with index 0 / probability 0). The
+    # tables are stored slot-major, as (K, N) arrays with one contiguous row
+    # per neighbor slot; succIdx, predProb etc. are their (N, K) transposes.
+    def __init__( self, stateDict ):
+        N = len(stateDict.values)
+        succ = [ [] for _ in range(N) ]
+        pred = [ [] for _ in range(N) ]
+
+        for s in stateDict.values:
+            nextStates = transition_model(s)
+            sIdx = stateDict.vToIndex(s)
+            for ns in nextStates.keys():
+                nsIdx = stateDict.vToIndex(ns)
+                p = nextStates[ns]
+                if p > 0:
+                    succ[sIdx].append((nsIdx, p))
+                    pred[nsIdx].append((sIdx, p))
+
+        succIdx, succProb = self._pad(succ)
+        predIdx, predProb = self._pad(pred)
+        self._setArrays(succIdx, succProb, predIdx, predProb)
+
+    @classmethod
+    def fromArrays( cls, succIdx, succProb, predIdx, predProb ):
+        # rebuilds the matrix from the arrays stored by HMM.save()
+        A = cls.__new__(cls)
+        A._setArrays(succIdx, succProb, predIdx, predProb)
+        return A
+
+    @classmethod
+    def fromSlotArrays( cls, succIdxT, succProbT, predIdxT, predProbT,
+                        predCostT ):
+        # wraps the (K, N) tables as they are kept, e.g. views into shared
+        # memory (see SharedModel), without copying or deriving anything
+        A = cls.__new__(cls)
+        A.N = succIdxT.shape[1]
+        A.succIdxT, A.succProbT = succIdxT, succProbT
+        A.predIdxT, A.predProbT, A.predCostT = predIdxT, predProbT, predCostT
+        A.powers = None
+        A.steppedWork = 0
+        return A
+
+    def _setArrays( self, succIdx, succProb, predIdx, predProb ):
+        # takes (N, K) tables
+        self.N = len(succIdx)
+        self.succIdxT = np.ascontiguousarray(np.asarray(succIdx,
+                                                        dtype=np.intp).T)
+        self.succProbT = np.ascontiguousarray(np.asarray(succProb,
+                                                         dtype=float).T)
+        self.predIdxT = np.ascontiguousarray(np.asarray(predIdx,
+                                                        dtype=np.intp).T)
+        self.predProbT = np.ascontiguousarray(np.asarray(predProb,
+                                                         dtype=float).T)
+        # -log2 of the predecessor probabilities, padding slots cost +inf
+        self.predCostT = careful_log2(self.predProbT)
+        # dense A^(2^j), j = 0, 1, ..., built on demand by forwardPower(),
+        # and the work forwardPower() has spent stepping so far
+        self.powers = None
+        self.steppedWork = 0
+
+    succIdx = property(lambda self: self.succIdxT.T)
+    succProb = property(lambda self: self.succProbT.T)
+    predIdx = property(lambda self: self.predIdxT.T)
+    predProb = property(lambda self: self.predProbT.T)
+    predCost = property(lambda self: self.predCostT.T)
+
+    @staticmethod
+    def _pad( rows, padIdx = 0 ):
+        K = max(len(r) for r in rows)
+        idx = np.full((len(rows), K), padIdx, dtype=np.intp)
+        prob = np.zeros((len(rows), K))
+        for i, r in enumerate(rows):
+            for k, (j, p) in enumerate(r):
+                idx[i, k] = j
+                prob[i, k] = p
+        return idx, prob
+
+    @staticmethod
+    def _invert( idx, prob, numRows, padIdx = 0 ):
+        # transposes a padded neighbor table: row j of the result lists the
+        # (i, prob) pairs with idx[i, k] == j, in increasing order of i --
+        # the same layout _pad() gives when the rows are filled state by state
+        src = np.repeat(np.arange(idx.shape[0]), idx.shape[1])
+        keep = prob.ravel() > 0
+        src = src[keep]
+        dst = idx.ravel()[keep]
+        p = prob.ravel()[keep]
+        order = np.argsort(dst, kind='stable')
+        src, dst, p = src[order], dst[order], p[order]
+
+        counts = np.bincount(dst, minlength=numRows)
+        slot = np.arange(len(dst)) - (np.cumsum(counts) - counts)[dst]
+        outIdx = np.full((numRows, counts.max(initial=0)), padIdx,
+                         dtype=np.intp)
+        outProb = np.zeros(outIdx.shape)
+        outIdx[dst, slot] = src
+        outProb[dst, slot] = p
+        return outIdx, outProb
+
+    # forward(), backward() and minPlus() act on the last axis of v, so a
+    # (batch, N) array of messages is processed in one go
+
+    def forward( self, v, out = None, work = None ):
+        # computes A.T @ v; given out (and optionally a scratch array work
+        # of the same shape) the result is written there without allocating
+        if out is not None:
+            return self._gatherSumInto(self.predIdxT, self.predProbT, v,
+                                       out, work)
+        return self._gatherSum(self.predIdxT, self.predProbT, v)
+
+    def backward( self, v, out = None, work = None ):
+        # computes A @ v, see forward() for out and work
+        if out is not None:
+            return self._gatherSumInto(self.succIdxT, self.succProbT, v,
+                                       out, work)
+        return self._gatherSum(self.succIdxT, self.succProbT, v)
+
+    @staticmethod
+    def _gatherSumInto( idxT, probT, v, out, work ):
+        # _gatherSum() into out, one neighbor slot at a time through work;
+        # mode='clip' keeps np.take from buffering out
+        if work is None:
+            work = np.empty(out.shape)
+        np.take(v, idxT[0], axis=-1, out=out, mode='clip')
+        np.multiply(out, probT[0], out=out)
+        for k in range(1, idxT.shape[0]):
+            np.take(v, idxT[k], axis=-1, out=work, mode='clip')
+            np.multiply(work, probT[k], out=work)
+            np.add(out, work, out=out)
+        return out
+
+    @staticmethod
+    def _gatherSum( idxT, probT, v ):
+        # accumulate one neighbor slot at a time rather than reducing over a
+        # (..., N, K) temporary
+        out = v[..., idxT[0]] * probT[0]
+        for k in range(1, idxT.shape[0]):
+            out += v[..., idxT[k]] * probT[k]
+        return out
+
+    # forwardPower() only squares dense copies of A for models up to this
+    # many states: a power takes N^2 floats and a squaring N^3 flops
+    DENSE_POWER_LIMIT = 512
+
+    def forwardPower( self, v, k ):
+        # (A.T)^k @ v, e.g. to jump over a run of k missing observations.
+        # Stepping costs k sparse products of N K flops each. Repeated
+        # squaring costs one dense N^2 product per set bit of k once the
+        # powers A^(2^j) exist, plus N^3 for every power still missing.
+        # Powers are only built once stepping has already spent that much
+        # (so long gaps never cost more than twice the better choice), and
+        # only for small models
+        N = self.N
+        k = int(k)
+        if N > self.DENSE_POWER_LIMIT or k == 0:
+            return self._step(v, k)
+        K = self.succIdxT.shape[0]
+        have = 0 if self.powers is None else len(self.powers)
+        build = max(0, k.bit_length() - have) * N ** 3
+        dense = bin(k).count('1') * N * N
+        if dense + build > k * N * K + (self.steppedWork if build else 0):
+            self.steppedWork += k * N * K
+            return self._step(v, k)
+
+        j = 0
+        while k:
+            if k & 1:
+                v = v @ self.getPower(j)
+            k >>= 1
+            j += 1
+        return v
+
+    def _step( self, v, k ):
+        for _ in range(k):
+            v = self.forward(v)
+        return v
+
+    def getPower( self, j ):
+        # dense A^(2^j), cached. Once squaring no longer changes the matrix
+        # (the chain has mixed) the last power is reused for all larger j,
+        # so at most log2 of the mixing time distinct powers are kept
+        if self.powers is None:
+            self.powers = [self.getTransitionMatrix()]
+        while len(self.powers) <= j:
+            P = self.powers[-1]
+            if len(self.powers) > 1 and P is self.powers[-2]:
+                self.powers.append(P)
+                continue
+            Q = P @ P
+            self.powers.append(P if np.allclose(Q, P, rtol=0, atol=1e-15)
+                               else Q)
+        return self.powers[j]
+
+    def minPlus( self, w ):
+        # Viterbi step in -log2 space: for every state j returns
+        # min_i (w[i] + cost(i -> j)) and the minimizing predecessor i
+        if w.ndim == 1:
+            v = self.predCostT + w[self.predIdxT]
+            k = v.argmin(axis=0)
+            cols = np.arange(len(w))
+            return v[k, cols], self.predIdxT[k, cols]
+
+        # for a batch we sweep the (few) predecessor slots with elementwise
+        # minima instead of reducing over a (batch, K, N) temporary
+        best = w[..., self.predIdxT[0]] + self.predCostT[0]
+        arg = np.broadcast_to(self.predIdxT[0], best.shape).copy()
+        for k in range(1, self.predIdxT.shape[0]):
+            v = w[..., self.predIdxT[k]] + self.predCostT[k]
+            better = v < best
+            np.copyto(best, v, where=better)
+            np.copyto(arg, np.broadcast_to(self.predIdxT[k], arg.shape),
+                      where=better)
+        return best, arg
+
+    def getTransitionMatrix( self ):
+        # dense version, only meant for small grids / debugging
+        N = self.N
+        A = np.zeros((N, N))
+        np.add.at(A, (np.repeat(np.arange(N), self.succIdx.shape[1]),
+                      self.succIdx.ravel()), self.succProb.ravel())
+        return A
+
+
+class GridTransitionMatrix(SparseTransitionMatrix):
+    # Structured form of the robot's transition matrix. A state (x, y, a)
+    # only ever moves into channel c of the neighboring cell SHIFTS[c] away,
+    # so on a (5, W, H) tensor of per-state values one step is a handful of
+    # per-channel scalings and array shifts; no neighbor indices are needed.
+    # All that is stored is one (W, H) grid of probabilities per (a, c)
+    # channel pair, from robot.build_model_tables(). The padded tables of
+    # SparseTransitionMatrix are only built if some code reads them
+    # (k_best_paths, Baum-Welch, simulate, HMM.save()).
+    # Moving between the per-state and the tensor layout costs about as much
+    # as a sparse step, so this only pays off on large grids: HMM.fromTables()
+    # uses it from MIN_STATES states on, and the plain sparse tables below.
+
+    # measured crossover; at 12x8 a sparse step is 3-6x faster, at 100x100
+    # the tensor step is 1.3-1.6x faster
+    MIN_STATES = 10000
+
+    # cell offset of a move into each channel, indexed like ACTIONS
+    SHIFTS = robot.ACTION_SHIFTS
+    # the order in which transition_model() lists the successors of a state
+    SUCCESSOR_ORDER = (4, 2, 3, 0, 1)
+    # attributes set by _setArrays(), see __getattr__()
+    TABLES = ('succIdxT', 'succProbT', 'predIdxT', 'predProbT', 'predCostT',
+              'powers', 'steppedWork')
+
+    def __init__( self, vocabulary, moves, moveProb ):
+        # vocabulary is the robot.GridStateIndex of the states; moves and
+        # moveProb are build_model_tables()' 'moves' and 'move_prob'
+        self.vocabulary = vocabulary
+        self.pairs = [(int(s), int(c)) for s, c in moves]
+        self.weights = np.asarray(moveProb, dtype=float)
+        self.shape = (5,) + self.weights.shape[1:]
+        self.N = len(vocabulary)
+
+    def __getattr__( self, name ):
+        # only called for attributes that are not set, i.e. the sparse
+        # tables, the -log2 weights and the state positions before their
+        # first use
+        if 'vocabulary' not in self.__dict__:
+            raise AttributeError(name)
+        if name in type(self).TABLES:
+            self._setArrays(*self._buildTables())
+        elif name == 'cost':
+            self.cost = careful_log2(self.weights)
+        elif name in ('pos', 'predCell'):
+            self._setPositions()
+        elif name == 'firstPred':
+            self.firstPred = self._firstPredecessors()
+        else:
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    def _setPositions( self ):
+        _, W, H = self.shape
+        x = self.vocabulary.x.astype(np.intp)
+        y = self.vocabulary.y.astype(np.intp)
+        action = self.vocabulary.action.astype(np.intp)
+        # position of every state in the flattened tensor
+        self.pos = (action * W + x) * H + y
+        # flat cell every state's predecessors sit in
+        shifts = np.array(self.SHIFTS)[action]
+        self.predCell = (x - shifts[:, 0]) * H + y - shifts[:, 1]
+
+    def _buildTables( self ):
+        # the (N, K) successor and predecessor tables of _setArrays(), read
+        # off the channel pair grids: successors in transition_model()'s
+        # order, predecessors (which all sit in one cell) by action, i.e.
+        # by state index
+        _, W, H = self.shape
+        positions = self.vocabulary.positions
+        x, y, action = (self.vocabulary.x, self.vocabulary.y,
+                        self.vocabulary.action)
+        succIdxT = np.zeros((5, self.N), dtype=np.intp)
+        succProbT = np.zeros((5, self.N))
+        predIdxT = np.zeros((5, self.N), dtype=np.intp)
+        predProbT = np.zeros((5, self.N))
+        for (s, c), weight in zip(self.pairs, self.weights):
+            dx, dy = self.SHIFTS[c]
+            # transitions out of the states in channel s
+            i = np.flatnonzero(action == s)
+            k = self.SUCCESSOR_ORDER.index(c)
+            succProbT[k, i] = weight[x[i], y[i]]
+            succIdxT[k, i] = positions[np.clip(x[i] + dx, 0, W - 1),
+                                       np.clip(y[i] + dy, 0, H - 1), c]
+            # transitions into the states in channel c
+            j = np.flatnonzero(action == c)
+            fromX, fromY = x[j] - dx, y[j] - dy
+            predProbT[s, j] = weight[fromX, fromY]
+            predIdxT[s, j] = positions[fromX, fromY, s]
+        succIdxT, succProbT = self._compact(succIdxT, succProbT)
+        predIdxT, predProbT = self._compact(predIdxT, predProbT)
+        return succIdxT.T, succProbT.T, predIdxT.T, predProbT.T
+
+    @staticmethod
+    def _compact( idxT, probT ):
+        # moves the non-zero slots of every column to the front, in order,
+        # pads with index 0 and drops the slots no column uses
+        order = np.argsort(probT == 0, axis=0, kind='stable')
+        probT = np.take_along_axis(probT, order, axis=0)
+        idxT = np.where(probT > 0, np.take_along_axis(idxT, order, axis=0), 0)
+        K = (probT > 0).sum(axis=0).max(initial=0)
+        return idxT[:K], probT[:K]
+
+    def _firstPredecessors( self ):
+        # (5, W, H) channel of every state's lowest-numbered predecessor
+        first = np.zeros(self.shape, dtype=np.intp)
+        for (s, c), weight in reversed(list(zip(self.pairs, self.weights))):
+            source, target = self._slices(c)
+            np.copyto(first[(c,) + target], s, where=weight[source] > 0)
+        return first
+
+    def toGrid( self, v, fill = 0. ):
+        # (..., N) per-state values -> (..., 5, W, H) tensor, with fill at
+        # the (x, y, action) combinations that are not states
+        t = np.full(v.shape[:-1] + (np.prod(self.shape),), fill)
+        t[..., self.pos] = v
+        return t.reshape(v.shape[:-1] + self.shape)
+
+    def fromGrid( self, t, out = None ):
+        # inverse of toGrid(), written to out if given
+        flat = t.reshape(t.shape[:-3] + (-1,))
+        if out is None:
+            return flat[..., self.pos]
+        return np.take(flat, self.pos, axis=-1, out=out, mode='clip')
+
+    def _slices( self, c ):
+        # (source, target) cell slices of a move into channel c
+        dx, dy = self.SHIFTS[c]
+        _, W, H = self.shape
+        source = (slice(max(0, -dx), W - max(0, dx)),
+                  slice(max(0, -dy), H - max(0, dy)))
+        target = (slice(max(0, dx), W + min(0, dx)),
+                  slice(max(0, dy), H + min(0, dy)))
+        return source, target
+
+    def forwardGrid( self, t ):
+        # A.T @ v on the tensor layout
+        out = np.zeros(t.shape)
+        for c in range(5):
+            acc = None
+            for (s, c2), weight in zip(self.pairs, self.weights):
+                if c2 == c:
+                    term = weight * t[..., s, :, :]
+                    acc = term if acc is None else acc + term
+            if acc is not None:
+                source, target = self._slices(c)
+                out[(Ellipsis, c) + target] = acc[(Ellipsis,) + source]
+        return out
+
+    def backwardGrid( self, t ):
+        # A @ v on the tensor layout
+        out = np.zeros(t.shape)
+        for (s, c), weight in zip(self.pairs, self.weights):
+            source, target = self._slices(c)
+            out[(Ellipsis, s) + source] += \
+                weight[source] * t[(Ellipsis, c) + target]
+        return out
+
+    def minPlusGrid( self, t ):
+        # minPlus() on the tensor layout, t holding +inf at non-states;
+        # returns the costs and the channel of the best predecessor, which
+        # sits at the cell SHIFTS[c] behind channel c. Candidates are tried
+        # in increasing channel order, so ties go to the lowest state index
+        # like in SparseTransitionMatrix.minPlus(), and where the cost is
+        # +inf the channel is that of the first possible predecessor
+        best = np.full(t.shape, np.inf)
+        arg = np.broadcast_to(self.firstPred, t.shape).copy()
+        for c in range(5):
+            source, target = self._slices(c)
+            b = best[(Ellipsis, c) + target]
+            a = arg[(Ellipsis, c) + target]
+            for (s, c2), cost in zip(self.pairs, self.cost):
+                if c2 != c:
+                    continue
+                v = t[(Ellipsis, s) + source] + cost[source]
+                better = v < b
+                np.copyto(b, v, where=better)
+                np.copyto(a, s, where=better)
+        return best, arg
+
+    # out= only saves the final per-state array here (work is not used):
+    # the in-place sparse gathers would need the padded tables
+
+    def forward( self, v, out = None, work = None ):
+        return self.fromGrid(self.forwardGrid(self.toGrid(v)), out)
+
+    def backward( self, v, out = None, work = None ):
+        return self.fromGrid(self.backwardGrid(self.toGrid(v)), out)
+
+    def minPlus( self, w ):
+        best, arg = self.minPlusGrid(self.toGrid(w, np.inf))
+        best, arg = self.fromGrid(best), self.fromGrid(arg)
+        # predecessor channel -> predecessor state index
+        positions = self.vocabulary.positions.reshape(-1, 5)
+        return best, positions[self.predCell, arg].astype(np.intp)
+
+
+class SparseEmissionMatrix:
+    # Each observation can only be produced by the handful of states within
+    # the sensor radius, so we store for every observation the (padded) list
+    # of states that can emit it together with the emission probabilities.
+    def __init__( self, sDict, oDict ):
+        N = len(sDict.values)
+        L = len(oDict.values)
+        emitters = [ [] for _ in range(L) ]
+
+        for s in sDict.values:
+            obs = observation_model(s)
+            sIdx = sDict.vToIndex(s)
+            for o in obs.keys():
+                oIdx = oDict.vToIndex(o)
+                p = obs[o]
+                if p > 0:
+                    emitters[oIdx].append((sIdx, p))
+
+        # padding slots point at a scratch entry N, see getColumn()
+        obsStateIdx, obsStateProb = SparseTransitionMatrix._pad(emitters, N)
+        self._setArrays(N, obsStateIdx, obsStateProb)
+
+    @classmethod
+    def fromArrays( cls, N, obsStateIdx, obsStateProb ):
+        B = cls.__new__(cls)
+        B._setArrays(N, obsStateIdx, obsStateProb)
+        return B
+
+    def _setArrays( self, N, obsStateIdx, obsStateProb ):
+        self.N = int(N)
+        self.obsStateIdx = np.asarray(obsStateIdx, dtype=np.intp)
+        self.obsStateProb = np.asarray(obsStateProb, dtype=float)
+
+    def getSparseColumn( self, obsIndex ):
+        # the non-zero entries of B[:, obsIndex]: the indices of the states
+        # that can emit the observation (in increasing order) and the
+        # emission probabilities
+        keep = self.obsStateProb[obsIndex] > 0
+        return (self.obsStateIdx[obsIndex][keep],
+                self.obsStateProb[obsIndex][keep])
+
+    def getColumn( self, obsIndex, out = None ):
+        # dense column B[:, obsIndex]; out, if given, is a reusable buffer of
+        # length N + 1 that the column is written to
+        if out is None:
+            col = np.zeros((self.N + 1,))
+        else:
+            col = out
+            col.fill(0.)
+        col[self.obsStateIdx[obsIndex]] = self.obsStateProb[obsIndex]
+        return col[:self.N]
+
+    def getLikelihoods( self, obsIndices ):
+        # B[:, o].T for every entry o of an index array of any shape; a
+        # negative index marks a missing observation (all-ones likelihood)
+        obsIndices = np.asarray(obsIndices)
+        flat = obsIndices.ravel()
+        E = np.ones((flat.size, self.N + 1))
+        seen = np.flatnonzero(flat >= 0)
+        E[seen] = 0
+        E[seen[:, None], self.obsStateIdx[flat[seen]]] = \
+            self.obsStateProb[flat[seen]]
+        return E[:, :self.N].reshape(obsIndices.shape + (self.N,))
+
+    def getStateEmissions( self ):
+        # the same probabilities laid out per state: for every state the
+        # (padded) indices and probabilities of the observations it can emit
+        emissions = [ [] for _ in range(self.N) ]
+        for o in range(self.obsStateIdx.shape[0]):
+            for s, p in zip(self.obsStateIdx[o], self.obsStateProb[o]):
+                if p > 0:
+                    emissions[s].append((o, p))
+        return SparseTransitionMatrix._pad(emissions)
+
+
+class GridEmissionMatrix(SparseEmissionMatrix):
+    # Stencil form of the robot's emission matrix. An observation of cell o
+    # can only come from states in the (up to) five cells of o's sensor
+    # stencil, and P(o | state) is the same for every action: one over the
+    # number of on-grid cells in the stencil of the state's cell. So all we
+    # keep is that (W, H) grid, and the state index of every (x, y, action)
+    # is read from the vocabulary's positions array; likelihoods are
+    # computed from the stencil when asked for. The padded
+    # emitter tables of SparseEmissionMatrix are only built if some code
+    # reads them (Baum-Welch, HMM.save()).
+
+    # cell offsets in observation_model()'s order
+    STENCIL = ((-1, 0), (0, -1), (0, 0), (0, 1), (1, 0))
+
+    def __init__( self, vocabulary, cellProb ):
+        # vocabulary is the robot.GridStateIndex of the states, cellProb
+        # build_model_tables()' 'obs_prob'
+        self.vocabulary = vocabulary
+        self.N = len(vocabulary)
+        self.cellProb = np.asarray(cellProb, dtype=float)
+        self._tables = None
+
+    @property
+    def obsStateIdx( self ):
+        return self._emitterTables()[0]
+
+    @property
+    def obsStateProb( self ):
+        return self._emitterTables()[1]
+
+    def _emitterTables( self ):
+        if self._tables is None:
+            self._tables = SparseTransitionMatrix._invert(
+                *self.getStateEmissions(), self.cellProb.size, self.N)
+        return self._tables
+
+    def _stencil( self, obsIndices ):
+        # (n, 25) state indices and probabilities of the states that can
+        # emit each of the n observations, sorted by state index and padded
+        # with index N / probability 0
+        W, H = self.cellProb.shape
+        ox, oy = np.divmod(np.asarray(obsIndices, dtype=np.intp), H)
+        idx = np.empty((len(ox), 5 * len(self.STENCIL)), dtype=np.intp)
+        prob = np.empty(idx.shape)
+        for k, (dx, dy) in enumerate(self.STENCIL):
+            x, y = ox + dx, oy + dy
+            inside = (x >= 0) & (x < W) & (y >= 0) & (y < H)
+            x, y = np.clip(x, 0, W - 1), np.clip(y, 0, H - 1)
+            states = self.vocabulary.positions[x, y]
+            idx[:, 5 * k:5 * k + 5] = np.where(
+                inside[:, None] & (states >= 0), states, self.N)
+            prob[:, 5 * k:5 * k + 5] = self.cellProb[x, y][:, None]
+        prob[idx == self.N] = 0
+        return idx, prob
+
+    def getSparseColumn( self, obsIndex ):
+        W, H = self.cellProb.shape
+        ox, oy = divmod(int(obsIndex), H)
+        block = (slice(max(ox - 1, 0), min(ox + 2, W)),
+                 slice(max(oy - 1, 0), min(oy + 2, H)))
+        x, y = np.ogrid[block]
+        near = np.abs(x - ox) + np.abs(y - oy) <= 1
+        # cells come out in x, y order, i.e. sorted by state index
+        idx = self.vocabulary.positions[block][near]
+        prob = np.broadcast_to(self.cellProb[block][near][:, None], idx.shape)
+        keep = idx >= 0
+        return idx[keep].astype(np.intp), prob[keep]
+
+    def getColumn( self, obsIndex, out = None ):
+        if out is None:
+            col = np.zeros((self.N + 1,))
+        else:
+            col = out
+            col.fill(0.)
+        idx, prob = self.getSparseColumn(obsIndex)
+        col[idx] = prob
+        return col[:self.N]
+
+    def getLikelihoods( self, obsIndices ):
+        obsIndices = np.asarray(obsIndices)
+        flat = obsIndices.ravel()
+        E = np.ones((flat.size, self.N + 1))
+        seen = np.flatnonzero(flat >= 0)
+        E[seen] = 0
+        idx, prob = self._stencil(flat[seen])
+        E[seen[:, None], idx] = prob
+        return E[:, :self.N].reshape(obsIndices.shape + (self.N,))
+
+    def getStateEmissions( self ):
+        # per state, the stencil around its own cell (observation indices
+        # are cell indices x * H + y), off-grid cells moved to the end
+        W, H = self.cellProb.shape
+        x = self.vocabulary.x.astype(np.intp)
+        y = self.vocabulary.y.astype(np.intp)
+        obs = np.stack([(x + dx) * H + y + dy for dx, dy in self.STENCIL],
+                       axis=1)
+        inside = np.stack([(x + dx >= 0) & (x + dx < W) &
+                           (y + dy >= 0) & (y + dy < H)
+                           for dx, dy in self.STENCIL], axis=1)
+        order = np.argsort(~inside, axis=1, kind='stable')
+        inside = np.take_along_axis(inside, order, axis=1)
+        emitIdx = np.where(inside, np.take_along_axis(obs, order, axis=1), 0)
+        emitProb = np.where(inside, self.cellProb[x, y][:, None], 0.)
+        K = inside.sum(axis=1).max(initial=0)
+        return emitIdx[:, :K], emitProb[:, :K]
+
+
 class DMatrix:
     def __init__( self, d , matrixSize , sDict ):
        
@@ -86,6 +700,256 @@ class DMatrix:
 
     
 
+ACTIONS = robot.ACTIONS
+
+
+class HMM:
+    # Compiled hidden Markov model: state/observation indexing, the sparse
+    # transition and emission matrices and the prior, built once from the
+    # robot model. Use getModel() to get the memoized instance for the
+    # current grid, or HMM.load() to read one saved with save().
+    def __init__( self, states, observedStates, A, B, prior ):
+        # states and observedStates are lists or robot.StateIndex objects
+        self.sDict = ValToIndex(states)
+        self.oDict = ValToIndex(observedStates)
+        # shared by every ArrayDistribution this model hands out
+        self.vocabulary = self.sDict.vocabulary
+        self.states = self.vocabulary.keys
+        self.observedStates = self.oDict.values
+        self.A = A
+        self.B = B
+        self.prior = np.asarray(prior, dtype=float)
+        self.N = len(self.states)
+        self.L = len(self.observedStates)
+
+        # impossible initial states cost +inf
+        self.priorCost = careful_log2(self.prior)
+
+        # likelihood / cost vectors of a missing observation, shared (and
+        # read-only) instead of allocated per step
+        self.missingLikelihood = np.ones(self.N)
+        self.missingCost = np.zeros(self.N)
+        self.missingLikelihood.flags.writeable = False
+        self.missingCost.flags.writeable = False
+
+    @classmethod
+    def build( cls ):
+        # the stock robot model has closed-form tables computed straight
+        # from the grid geometry; any other model is built by querying
+        # transition_model / observation_model state by state
+        if transition_model is robot.transition_model and \
+                observation_model is robot.observation_model:
+            return cls.fromTables(robot.build_model_tables())
+
+        states = robot.get_all_hidden_states()
+        observedStates = robot.get_all_observed_states()
+        sDict = ValToIndex(states)
+        oDict = ValToIndex(observedStates)
+        A = SparseTransitionMatrix(sDict)
+        B = SparseEmissionMatrix(sDict, oDict)
+        prior = DMatrix(robot.initial_distribution(), len(states),
+                        sDict).getMatrix()
+        return cls(sDict.vocabulary, oDict.vocabulary, A, B, prior)
+
+    @classmethod
+    def fromTables( cls, tables ):
+        # builds the model from robot.build_model_tables(). States and
+        # observations are indexed through their coordinate arrays (no
+        # tuples or dicts are made) and both matrices keep the per-cell
+        # tables as they are, except that small grids get the plain sparse
+        # transition tables (see GridTransitionMatrix)
+        states = robot.GridStateIndex(tables['state_x'], tables['state_y'],
+                                      tables['state_action'])
+        W, H = tables['obs_prob'].shape
+        # observations are the cells, numbered x * H + y
+        observedX, observedY = np.divmod(np.arange(W * H, dtype=np.int32),
+                                         np.int32(H))
+        observedStates = robot.GridStateIndex(observedX, observedY)
+        A = GridTransitionMatrix(states, tables['moves'], tables['move_prob'])
+        if A.N < A.MIN_STATES:
+            A = SparseTransitionMatrix.fromArrays(*A._buildTables())
+        B = GridEmissionMatrix(states, tables['obs_prob'])
+        return cls(states, observedStates, A, B, tables['prior'])
+
+    def getEmissionProb( self, obs, useLog = False ):
+        if isMissing(obs):
+            return self.missingCost if useLog else self.missingLikelihood
+        return getEmissionProb(obs, self.B, self.oDict, useLog)
+
+    def getEmissionProbInto( self, obs, out ):
+        # getEmissionProb() written to out, a buffer of length N + 1 (e.g.
+        # MessageWorkspace.column); missing observations still get the
+        # shared all-ones vector
+        if isMissing(obs):
+            return self.missingLikelihood
+        if not isinstance(obs, (int, np.integer)):
+            obs = self.oDict.vToIndex(obs)
+        return self.B.getColumn(obs, out)
+
+    def getLikelihood( self, observation ):
+        return self.getEmissionProb(observation)
+
+    def getEmissionCosts( self, obsIndices ):
+        # -log2 of getLikelihoods(), +inf for states that cannot have
+        # produced the observation
+        return careful_log2(self.B.getLikelihoods(obsIndices))
+
+    def trackDtype( self ):
+        # integer type of the index arrays in robot's binary track format
+        if max(self.N, self.L) <= np.iinfo(np.int16).max:
+            return np.int16
+        return np.int32
+
+    def backPointerDtype( self ):
+        # smallest unsigned integer type that can hold a state index
+        return np.uint16 if self.N <= np.iinfo(np.uint16).max else np.uint32
+
+    def observationIndices( self, observations ):
+        # maps a list of observations to indices into self.observedStates,
+        # with -1 for a missing observation; index arrays, and elements that
+        # already are indices (negative ones, e.g. robot.MISSING, meaning
+        # missing), pass through
+        if isinstance(observations, np.ndarray):
+            return observations.astype(np.intp)
+        return np.array([-1 if isMissing(o) else
+                         o if isinstance(o, (int, np.integer)) else
+                         self.oDict.vToIndex(o)
+                         for o in observations], dtype=np.intp)
+
+    def batchObservationIndices( self, observations, lengths = None ):
+        # pads a list of observation sequences into a (batch, T) index array;
+        # a 2D index array is used as is together with its lengths
+        if isinstance(observations, np.ndarray):
+            obsIdx = observations.astype(np.intp)
+            if lengths is None:
+                lengths = np.full(obsIdx.shape[0], obsIdx.shape[1])
+            return obsIdx, np.asarray(lengths, dtype=np.intp)
+
+        seqs = [self.observationIndices(o) for o in observations]
+        lengths = np.array([len(s) for s in seqs], dtype=np.intp)
+        obsIdx = np.full((len(seqs), lengths.max(initial=0)), -1,
+                         dtype=np.intp)
+        for b, s in enumerate(seqs):
+            obsIdx[b, :len(s)] = s
+        return obsIdx, lengths
+
+    def toDistribution( self, p ):
+        # wraps a probability vector over self.states (without copying it)
+        # as an ArrayDistribution, which reads like a Distribution
+        return robot.ArrayDistribution(self.vocabulary, p)
+
+    def gridVocabularies( self ):
+        # the states and observations as robot.GridStateIndex objects
+        states, observed = self.vocabulary, self.oDict.vocabulary
+        if not isinstance(states, robot.GridStateIndex):
+            states = robot.GridStateIndex(
+                [s[0] for s in states.keys], [s[1] for s in states.keys],
+                [ACTIONS.index(s[2]) for s in states.keys])
+        if not isinstance(observed, robot.GridStateIndex):
+            observed = robot.GridStateIndex([o[0] for o in observed.keys],
+                                            [o[1] for o in observed.keys])
+        return states, observed
+
+    def toArrays( self ):
+        # everything needed to rebuild the model, as a dict of NumPy arrays
+        states, observed = self.gridVocabularies()
+        return dict(
+            stateX=states.x, stateY=states.y, stateAction=states.action,
+            observedX=observed.x, observedY=observed.y,
+            succIdx=self.A.succIdx, succProb=self.A.succProb,
+            predIdx=self.A.predIdx, predProb=self.A.predProb,
+            obsStateIdx=self.B.obsStateIdx,
+            obsStateProb=self.B.obsStateProb,
+            prior=self.prior)
+
+    @classmethod
+    def fromArrays( cls, f ):
+        # inverse of toArrays(); the matrices are used without copying
+        states = robot.GridStateIndex(f['stateX'], f['stateY'],
+                                      f['stateAction'])
+        observedStates = robot.GridStateIndex(f['observedX'],
+                                              f['observedY'])
+        A = SparseTransitionMatrix.fromArrays(f['succIdx'], f['succProb'],
+                                              f['predIdx'], f['predProb'])
+        B = SparseEmissionMatrix.fromArrays(len(states), f['obsStateIdx'],
+                                            f['obsStateProb'])
+        return cls(states, observedStates, A, B, f['prior'])
+
+    def toSharedArrays( self ):
+        # like toArrays(), but with the matrices in the form they are used
+        # in (the slot-major sparse tables and their costs, or the per-cell
+        # tables of the grid operators) and the vocabularies' positions, so
+        # that fromSharedArrays() has nothing to derive
+        states, observed = self.gridVocabularies()
+        f = dict(stateX=states.x, stateY=states.y, stateAction=states.action,
+                 statePositions=states.positions,
+                 observedX=observed.x, observedY=observed.y,
+                 observedPositions=observed.positions, prior=self.prior)
+        if isinstance(self.A, GridTransitionMatrix):
+            f.update(moves=np.array(self.A.pairs), moveProb=self.A.weights)
+        else:
+            f.update(succIdxT=self.A.succIdxT, succProbT=self.A.succProbT,
+                     predIdxT=self.A.predIdxT, predProbT=self.A.predProbT,
+                     predCostT=self.A.predCostT)
+        if isinstance(self.B, GridEmissionMatrix):
+            f.update(cellProb=self.B.cellProb)
+        else:
+            f.update(obsStateIdx=self.B.obsStateIdx,
+                     obsStateProb=self.B.obsStateProb)
+        return f
+
+    @classmethod
+    def fromSharedArrays( cls, f ):
+        # inverse of toSharedArrays(); every array is used as it is. What is
+        # still allocated per process: the length-N prior cost and
+        # missing-observation vectors of __init__(), plus whatever the grid
+        # operators derive lazily (e.g. their positions in the tensor
+        # layout)
+        states = robot.GridStateIndex(f['stateX'], f['stateY'],
+                                      f['stateAction'], f['statePositions'])
+        observedStates = robot.GridStateIndex(
+            f['observedX'], f['observedY'], positions=f['observedPositions'])
+        if 'moves' in f:
+            A = GridTransitionMatrix(states, f['moves'], f['moveProb'])
+        else:
+            A = SparseTransitionMatrix.fromSlotArrays(
+                f['succIdxT'], f['succProbT'], f['predIdxT'], f['predProbT'],
+                f['predCostT'])
+        if 'cellProb' in f:
+            B = GridEmissionMatrix(states, f['cellProb'])
+        else:
+            B = SparseEmissionMatrix.fromArrays(len(states), f['obsStateIdx'],
+                                                f['obsStateProb'])
+        return cls(states, observedStates, A, B, f['prior'])
+
+    def save( self, filename ):
+        # writes the compiled model to a .npz file
+        np.savez(filename, **self.toArrays())
+
+    @classmethod
+    def load( cls, filename ):
+        # reads a model written by save()
+        with np.load(filename) as f:
+            return cls.fromArrays(f)
+
+
+_model_cache = dict()
+
+
+def getModel():
+    """
+    Returns the compiled HMM for the current robot model. The model is built
+    on first use and memoized on the grid size and model functions, so
+    repeated calls to forward_backward / Viterbi / second_best only pay for
+    the message passing.
+    """
+    key = (robot.GRID_WIDTH, robot.GRID_HEIGHT, transition_model,
+           observation_model)
+    if key not in _model_cache:
+        _model_cache[key] = HMM.build()
+    return _model_cache[key]
+
+
 # You may find this function helpful for computing logs without yielding a
 # NumPy warning when taking the log of 0.
 def careful_log(x):
@@ -96,27 +960,55 @@ def careful_log(x):
         return (-1 * np.log(x))
 
 
+def careful_log2(x):
+    # elementwise -log2 of a non-negative array, +inf where it is 0, so that
+    # impossible events drop out of every min/argmin
+    with np.errstate(divide='ignore'):
+        return -np.log2(x)
+
+
 # -----------------------------------------------------------------------------
 # Functions for you to implement
 #
+def isMissing( obs ):
+    # None, robot.MISSING or any other negative observation index
+    return obs is None or (isinstance(obs, (int, np.integer)) and obs < 0)
+
 def getEmissionProb( obs, B, oDict, useLog =False ):
-    N = len(all_possible_hidden_states)
-    if obs == None:
+    # obs may also be an index into the observed states (robot.MISSING, or
+    # any negative index, for a missing observation)
+    N = B.N if isinstance(B, SparseEmissionMatrix) else B.shape[0]
+    isIndex = isinstance(obs, (int, np.integer))
+    if isMissing(obs):
         if useLog == False:
             emmisProb = np.ones(N,)
         else:
             emmisProb = np.zeros(N,)
     else:
-        obsIndex  = oDict.vToIndex(obs)
-        emmisProb = B[:, obsIndex ]
+        obsIndex  = obs if isIndex else oDict.vToIndex(obs)
+        if isinstance(B, SparseEmissionMatrix):
+            emmisProb = B.getColumn( obsIndex )
+            if useLog:
+                emmisProb = careful_log2(emmisProb)
+        else:
+            emmisProb = B[:, obsIndex ]
     return emmisProb    
     
-def forward_backward(observations):
+def forward_backward(observations, model=None, checkpoint=False,
+                     return_log_likelihood=False, workspace=None):
     """
     Input
     -----
     observations: a list of observations, one per hidden state
-        (a missing observation is encoded as None)
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
+    checkpoint: if True, only every sqrt(T)-th forward message is stored
+        and the others are recomputed segment by segment during the
+        backward pass (about twice the work, O(N * sqrt(T)) message memory)
+    return_log_likelihood: also return log P(observations) (natural log)
+    workspace: a MessageWorkspace to reuse across calls, so the message
+        passing does not allocate (ignored with checkpoint)
 
     Output
     ------
@@ -125,6 +1017,8 @@ def forward_backward(observations):
     robot.py and see how it is used in both robot.py and the function
     generate_data() above, and the i-th Distribution should correspond to time
     step i
+    The distributions are ArrayDistributions over rows of one shared array.
+    With return_log_likelihood, a (marginals, log-likelihood) pair.
     """
 
     # -------------------------------------------------------------------------
@@ -132,87 +1026,524 @@ def forward_backward(observations):
     #
 
     
-    sDict = ValToIndex(all_possible_hidden_states)
-    oDict = ValToIndex(all_possible_observed_states)
-    A = TransitionMatrix(sDict).getTransitionMatrix()
-    
-    B = EmissionMatrx( sDict, oDict).getEmissionMatrix()
+    if model is None:
+        model = getModel()
 
-    
-    forward_messages = calcForwardMessages( observations, A, B, sDict, oDict )
-    #print(forward_messages[:,0])
-    #print(forward_messages[:,1])
-    # TODO: Compute the forward messages
-    backward_messages = calcBackwardMessages(observations, A, B, sDict, oDict )
+    if checkpoint:
+        marginals, logLikelihood = calcMarginalsCheckpointed( observations, model )
+    else:
+        forward_messages, scales = calcForwardMessages( observations, model,
+                                                        True, workspace )
+        backward_messages = calcBackwardMessages( observations, model,
+                                                  workspace )
+        marginals = calcMarginals( observations, forward_messages, backward_messages, model)
+        logLikelihood = np.log(scales).sum()
+
+    if return_log_likelihood:
+        return marginals, logLikelihood
+    return marginals
 
-    marginals = calcMarginals( observations, forward_messages, backward_messages, B, sDict, oDict)
-    
-    
-    
-    
+
+def forward_backward_batch(observations, lengths=None, model=None,
+                           return_log_likelihood=False):
+    """
+    Input
+    -----
+    observations: either a list of observation sequences (each a list of
+        observations, None for a missing one), or a (batch, T) array of
+        observation indices padded with -1
+    lengths: length of every sequence when observations is an index array
+        (defaults to T for all of them)
+    model: compiled HMM to use (defaults to getModel())
+    return_log_likelihood: also return the (batch,) log-likelihoods
+
+    Output
+    ------
+    A (batch, T, N) array of marginals over model.states; entries past the
+    end of a sequence are zero
+    """
+    if model is None:
+        model = getModel()
+    obsIdx, lengths = model.batchObservationIndices(observations, lengths)
+    batch, num_time_steps = obsIdx.shape
+    N = model.N
+
+    # (T, batch, N): the likelihood of every step, padding counts as missing
+    E = model.B.getLikelihoods(obsIdx.T)
+    forward_messages, logScales = calcForwardMessagesBatch(
+        obsIdx, lengths, model, likelihoods=E)
+
+    marginals = np.empty((num_time_steps, batch, N))
+    beta = np.ones((batch, N))
+    for i in reversed(range(num_time_steps)):
+        m = forward_messages[i] * beta * E[i]
+        marginals[i] = m / m.sum(axis=1, keepdims=True)
+        if i > 0:
+            # sequences that have already ended keep an all-ones message
+            prev = model.A.backward(E[i] * beta)
+            prev /= prev.sum(axis=1, keepdims=True)
+            beta = np.where((i < lengths)[:, None], prev, 1.)
+
+    marginals = marginals.transpose(1, 0, 2)
+    marginals[np.arange(num_time_steps) >= lengths[:, None]] = 0
+    if return_log_likelihood:
+        return marginals, logScales.sum(axis=0)
     return marginals
 
 
-def calcForwardMessages(observations, A, B, sDict, oDict):
+def calcForwardMessagesBatch(obsIdx, lengths, model, keepMessages=True,
+                             likelihoods=None):
+    # Scaled forward pass over a (batch, T) index array. Returns the
+    # (T, batch, N) forward messages (None unless keepMessages) and the
+    # (T, batch) log normalizers log P(y_i | y_0..y_{i-1}), which are 0
+    # past the end of a sequence. likelihoods may hold the (T, batch, N)
+    # emission likelihoods if the caller already has them.
+    batch, num_time_steps = obsIdx.shape
+    forward_messages = None
+    if keepMessages:
+        forward_messages = np.empty((num_time_steps, batch, model.N))
+    logScales = np.zeros((num_time_steps, batch))
+
+    alpha = np.tile(model.prior, (batch, 1))
+    for i in range(num_time_steps):
+        if keepMessages:
+            forward_messages[i] = alpha
+        if likelihoods is None:
+            e = model.B.getLikelihoods(obsIdx[:, i])
+        else:
+            e = likelihoods[i]
+        if i < num_time_steps - 1:
+            alpha = model.A.forward(e * alpha)
+            scale = alpha.sum(axis=1)
+            alpha /= scale[:, None]
+        else:
+            scale = (e * alpha).sum(axis=1)
+        with np.errstate(divide='ignore'):
+            logScales[i] = np.where(i < lengths, np.log(scale), 0.)
+    return forward_messages, logScales
+
+
+def log_likelihood(observations, model=None, per_step=False):
+    """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
+    per_step: also return the log normalizers of the forward pass
+
+    Output
+    ------
+    log P(observations) (natural log); with per_step, a pair of it and the
+    array of log P(y_i | y_0..y_{i-1}) for every time step i
+    """
+    if model is None:
+        model = getModel()
+    if not per_step:
+        return calcLogLikelihood(model.observationIndices(observations), model)
+    forward_messages, scales = calcForwardMessages( observations, model, True )
+    with np.errstate(divide='ignore'):
+        logScales = np.log(scales)
+    return logScales.sum(), logScales
+
+
+def calcLogLikelihood(obsIdx, model):
+    # Forward pass that only keeps the current message. A missing
+    # observation has scale 1 (A is stochastic), so the run of them before
+    # every observed step is jumped over with a single A.forwardPower()
+    # call, and the ones after the last observed step are not visited.
+    observed = np.flatnonzero(obsIdx >= 0)
+    logLikelihood = 0.
+    alpha = model.prior
+    column = np.empty((model.N + 1,))
+    nextStep = 0
+    for n, i in enumerate(observed):
+        if i > nextStep:
+            alpha = model.A.forwardPower(alpha, i - nextStep)
+        a = model.B.getColumn(obsIdx[i], column) * alpha
+        scale = a.sum()
+        with np.errstate(divide='ignore'):
+            logLikelihood += np.log(scale)
+        if n < len(observed) - 1:
+            alpha = model.A.forward(a / scale)
+        nextStep = i + 1
+    return logLikelihood
+
+
+def score_batch(observations, lengths=None, model=None):
+    """
+    Input
+    -----
+    observations: either a list of observation sequences (each a list of
+        observations, None for a missing one), or a (batch, T) array of
+        observation indices padded with -1
+    lengths: length of every sequence when observations is an index array
+    model: compiled HMM to use (defaults to getModel())
+
+    Output
+    ------
+    A (batch,) array with the log-likelihood of every sequence, computed
+    with a forward pass only and O(batch * N) memory; sort it to rank tracks
+    or to pick out anomalous ones
+    """
+    if model is None:
+        model = getModel()
+    obsIdx, lengths = model.batchObservationIndices(observations, lengths)
+    forward_messages, logScales = calcForwardMessagesBatch(
+        obsIdx, lengths, model, keepMessages=False)
+    return logScales.sum(axis=0)
+
+
+class OnlineFilter:
+    # Incremental forward filter for live tracking. Observations are fed in
+    # one at a time with update() (an observation tuple, an observation
+    # index, or None when the reading is missing); each update costs one
+    # sparse transition step, independent of how long the track already is.
+    def __init__( self, model = None ):
+        self.model = getModel() if model is None else model
+        self.reset()
+
+    def reset( self ):
+        # predicted: P(x_t | y_0, ..., y_{t-1}) for the next time step t
+        self.predicted = self.model.prior.copy()
+        self.filtered = None
+        self.numObservations = 0
+        # log P(y_0, ..., y_t) and log P(y_t | y_0, ..., y_{t-1})
+        self.logLikelihood = 0.
+        self.logNormalizer = 0.
+
+    def update( self, observation ):
+        # ingests the next observation and returns the filtered
+        # distribution P(x_t | y_0, ..., y_t) as a vector over model.states
+        return self.updateLikelihood(self.model.getLikelihood(observation))
+
+    def updateLikelihood( self, likelihood ):
+        # same as update(), given the likelihood vector of the observation
+        f = self.predicted * likelihood
+        # the normalizer is P(y_t | y_0, ..., y_{t-1})
+        scale = f.sum()
+        f /= scale
+        self.logNormalizer = np.log(scale)
+        self.logLikelihood += self.logNormalizer
+        self.filtered = f
+        self.predicted = self.model.A.forward(f)
+        self.numObservations += 1
+        return f
+
+    def skip( self, k ):
+        # ingests a run of k missing observations at once (e.g. a sensor
+        # dropout) and returns the filtered distribution after the last one;
+        # the run is jumped over with A.forwardPower() instead of k updates
+        if k == 0:
+            return self.filtered
+        f = self.model.A.forwardPower(self.predicted, k - 1)
+        self.logNormalizer = 0.
+        self.filtered = f
+        self.predicted = self.model.A.forward(f)
+        self.numObservations += k
+        return f
+
+    def updateMany( self, observations ):
+        # feeds a block of observations (e.g. from robot.iter_load_data() or
+        # robot.iter_load_data_binary()) and returns the (len, N) array of
+        # filtered distributions
+        filtered = np.empty((len(observations), self.model.N))
+        for i, observation in enumerate(observations):
+            filtered[i] = self.update(observation)
+        return filtered
+
+    def getFiltered( self ):
+        return self.filtered
+
+    def getDistribution( self ):
+        # current filtered position distribution as a Distribution
+        if self.filtered is None:
+            return None
+        return self.model.toDistribution(self.filtered)
+
+
+class FixedLagSmoother:
+    # Fixed-lag smoother on top of OnlineFilter. Once the observation for
+    # time t has been passed to update(), it returns the smoothed marginal
+    # P(x_{t-lag} | y_0, ..., y_t). Only the last lag + 1 filtered messages
+    # and likelihood vectors are kept, so memory is O(N * lag) no matter how
+    # long the track is.
+    def __init__( self, lag, model = None ):
+        self.filter = OnlineFilter(model)
+        self.model = self.filter.model
+        self.lag = lag
+        self.filtered = collections.deque()
+        self.likelihoods = collections.deque()
+
+    def update( self, observation ):
+        # returns the smoothed marginal for time t - lag as a vector over
+        # model.states, or None during the first lag steps
+        e = self.model.getLikelihood(observation)
+        self.filtered.append(self.filter.updateLikelihood(e))
+        self.likelihoods.append(e)
+        if len(self.filtered) <= self.lag:
+            return None
+
+        beta = np.ones((self.model.N,))
+        for j in reversed(range(1, len(self.filtered))):
+            beta = self.model.A.backward(self.likelihoods[j] * beta)
+            beta /= beta.sum()
+        m = self.filtered[0] * beta
+        m /= m.sum()
+
+        self.filtered.popleft()
+        self.likelihoods.popleft()
+        return m
+
+    def updateMany( self, observations ):
+        # feeds a block of observations and returns the (possibly empty)
+        # array of smoothed marginals emitted while doing so
+        marginals = [self.update(o) for o in observations]
+        marginals = [m for m in marginals if m is not None]
+        return np.array(marginals).reshape(len(marginals), self.model.N)
+
+    def flush( self ):
+        # at the end of the stream, returns the marginals of the (at most
+        # lag) time steps that have not been emitted yet, in time order
+        marginals = []
+        beta = np.ones((self.model.N,))
+        for j in reversed(range(len(self.filtered))):
+            m = self.filtered[j] * beta
+            marginals.append(m / m.sum())
+            beta = self.model.A.backward(self.likelihoods[j] * beta)
+            beta /= beta.sum()
+
+        self.filtered.clear()
+        self.likelihoods.clear()
+        return list(reversed(marginals))
+
+
+class MessageWorkspace:
+    # Reusable buffers for calcForwardMessages() / calcBackwardMessages().
+    # Passing the same workspace to repeated calls (e.g. one per track of a
+    # log) means the recursions allocate nothing once the buffers have grown
+    # to the longest track. The message arrays returned by those calls are
+    # views into the workspace, overwritten by the next call.
+    def __init__( self, N ):
+        self.N = N
+        # messages are stored one time step per row, so that every step
+        # reads and writes contiguous memory; callers see the (N, T)
+        # transpose
+        self.forwardBuffer = np.empty((0, N))
+        self.backwardBuffer = np.empty((0, N))
+        self.scales = np.empty((0,))
+        # emission * message, one neighbor slot of a gather, and the
+        # emission column (with the scratch entry N)
+        self.weighted = np.empty((N,))
+        self.gathered = np.empty((N,))
+        self.column = np.empty((N + 1,))
+
+    def reserve( self, num_time_steps ):
+        # grows the message buffers (geometrically) to hold num_time_steps
+        if self.forwardBuffer.shape[0] < num_time_steps:
+            T = max(num_time_steps, 2 * self.forwardBuffer.shape[0])
+            self.forwardBuffer = np.empty((T, self.N))
+            self.backwardBuffer = np.empty((T, self.N))
+            self.scales = np.empty((T,))
+
+    def getForwardMessages( self, num_time_steps ):
+        self.reserve(num_time_steps)
+        return self.forwardBuffer[:num_time_steps].T
+
+    def getBackwardMessages( self, num_time_steps ):
+        self.reserve(num_time_steps)
+        return self.backwardBuffer[:num_time_steps].T
+
+    def getScales( self, num_time_steps ):
+        self.reserve(num_time_steps)
+        return self.scales[:num_time_steps]
+
+
+def calcForwardMessages(observations, model, returnScales = False,
+                        workspace = None):
+    # Scaled forward pass: forward_messages[:, i] is P(x_i | y_0..y_{i-1}).
+    # Because A is stochastic, the scale that renormalizes each message is
+    # P(y_i | y_0..y_{i-1}); with returnScales the scales of all T steps are
+    # returned too, and the sequence log-likelihood is the sum of their logs.
+    # Every step works in place in the buffers of workspace (a fresh
+    # MessageWorkspace if None).
     
     num_time_steps = len(observations)
-    N = len(all_possible_hidden_states)
-    forward_messages = np.zeros( (N,num_time_steps)  )
-    prior = DMatrix( prior_distribution, N, sDict)
-    forward_messages[:,0] = prior.getMatrix()
+    if workspace is None:
+        workspace = MessageWorkspace(model.N)
+    forward_messages = workspace.getForwardMessages(num_time_steps)
+    scales = workspace.getScales(num_time_steps)
+    scales.fill(1.)
+    if num_time_steps > 0:
+        forward_messages[:,0] = model.prior
     
     for i in range(0,num_time_steps-1):
         prevAlpha = forward_messages[:,i]
-        emmisProb = getEmissionProb( observations[i], B, oDict )
+        nextAlpha = forward_messages[:,i+1]
+        if not isMissing(observations[i]):
+            emmisProb = model.getEmissionProbInto( observations[i],
+                                                   workspace.column )
+            prevAlpha = np.multiply(emmisProb, prevAlpha,
+                                    out=workspace.weighted)
         
-        forward_messages[:,i+1] = A.T@(emmisProb * prevAlpha)
-        forward_messages[:,i+1] = forward_messages[:,i+1]/sum(forward_messages[:,i+1])
-                    
-    return forward_messages
+        model.A.forward(prevAlpha, nextAlpha, workspace.gathered)
+        scales[i] = nextAlpha.sum()
+        nextAlpha /= scales[i]
+
+    if not returnScales:
+        return forward_messages
+    if num_time_steps > 0:
+        emmisProb = model.getEmissionProbInto( observations[-1],
+                                               workspace.column )
+        scales[-1] = np.dot(emmisProb, forward_messages[:,-1])
+    return forward_messages, scales
     
-def calcBackwardMessages(observations,A, B, sDict, oDict):
+def calcBackwardMessages(observations, model, workspace = None):
+    # backward pass normalized to sum 1 at every step, in place like
+    # calcForwardMessages()
     
     num_time_steps = len(observations)
-    N = len(all_possible_hidden_states)
-    backward_messages = np.zeros( (N,num_time_steps)  )
-    backward_messages[:,num_time_steps-1] = np.ones((N,))
+    if workspace is None:
+        workspace = MessageWorkspace(model.N)
+    backward_messages = workspace.getBackwardMessages(num_time_steps)
+    if num_time_steps > 0:
+        backward_messages[:,num_time_steps-1] = 1.
     for i in reversed(range(1,num_time_steps)):
         
         prevBeta = backward_messages[:,i]
-        emmisProb = getEmissionProb( observations[i], B, oDict )
-        backward_messages[:,i-1] = A@(emmisProb * prevBeta)
-        backward_messages[:,i-1] = backward_messages[:,i-1]/sum(backward_messages[:,i-1])
+        nextBeta = backward_messages[:,i-1]
+        if not isMissing(observations[i]):
+            emmisProb = model.getEmissionProbInto( observations[i],
+                                                   workspace.column )
+            prevBeta = np.multiply(emmisProb, prevBeta,
+                                   out=workspace.weighted)
+        model.A.backward(prevBeta, nextBeta, workspace.gathered)
+        nextBeta /= nextBeta.sum()
                    
     return backward_messages
 
-def calcMarginals ( observations, forward_messages, backward_messages, B, sDict, oDict)  :
+def calcMarginals ( observations, forward_messages, backward_messages, model)  :
   
-    num_time_steps = len(observations)
-    marginals = []  
+    m = calcMarginalArray( observations, forward_messages, backward_messages, model)
+    return [model.toDistribution(row) for row in m]
+
+
+def calcMarginalArray ( observations, forward_messages, backward_messages, model,
+                        dtype = np.float64 ):
+    # all the marginals at once as a (T, N) array
+    E = model.B.getLikelihoods(model.observationIndices(observations))
+    m = forward_messages.T * backward_messages.T * E
+    m /= m.sum(axis=1, keepdims=True)
+    return m.astype(dtype, copy=False)
+
+
+class MarginalsView:
+    # Read-only sequence over a (T, N) marginal array that behaves like the
+    # list returned by forward_backward(): indexing gives an
+    # ArrayDistribution over one row, created only when it is asked for,
+    # and slicing gives another view.
+    def __init__( self, marginals, vocabulary ):
+        self.array = marginals
+        self.vocabulary = vocabulary
+        self.states = vocabulary.keys
+
+    def __len__( self ):
+        return self.array.shape[0]
+
+    def __getitem__( self, i ):
+        if isinstance(i, slice):
+            return MarginalsView(self.array[i], self.vocabulary)
+        return robot.ArrayDistribution(self.vocabulary, self.array[i])
+
+    def __iter__( self ):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def forward_backward_array(observations, model=None, dtype=np.float64,
+                           lazy=False):
+    """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
+    dtype: floating point type of the returned marginals
+    lazy: return a MarginalsView instead of the array and state list
+
+    Output
+    ------
+    A (T, N) array of marginals together with model.states, the list of
+    states that indexes its columns (shared by every call with the same
+    model); with lazy=True a MarginalsView wrapping both
+    """
+    if model is None:
+        model = getModel()
+
+    forward_messages = calcForwardMessages( observations, model )
+    backward_messages = calcBackwardMessages( observations, model )
+    marginals = calcMarginalArray( observations, forward_messages,
+                                   backward_messages, model, dtype )
+    if lazy:
+        return MarginalsView(marginals, model.vocabulary)
+    return marginals, model.states
     
     
+def calcMarginalsCheckpointed( observations, model ):
+    # forward-backward that keeps the forward message of every step-th time
+    # step only (step ~ sqrt(T)); during the backward pass the forward
+    # messages of one segment at a time are recomputed from its checkpoint
+    num_time_steps = len(observations)
+    step = max(1, int(np.ceil(np.sqrt(num_time_steps))))
+
+    checkpoints = []
+    logLikelihood = 0.
+    alpha = model.prior
     for i in range(num_time_steps):
-        d = robot.Distribution()
-        
-        emmisProb = getEmissionProb( observations[i], B, oDict )
+        if i % step == 0:
+            checkpoints.append(alpha)
+        emmisProb = model.getEmissionProb( observations[i] )
+        if i < num_time_steps - 1:
+            alpha = model.A.forward(emmisProb * alpha)
+            scale = alpha.sum()
+            alpha = alpha / scale
+        else:
+            scale = (emmisProb * alpha).sum()
+        logLikelihood += np.log(scale)
 
-        m = (forward_messages[:,i] * backward_messages[:,i])*emmisProb
-        m[:] = m[:]/sum(m)
-        for idx, p in enumerate(m):
-            state = all_possible_hidden_states[idx]
-            d[state] = p
+    marginals = [None] * num_time_steps
+    beta = np.ones((model.N,))
+    for seg in reversed(range(len(checkpoints))):
+        start = seg * step
+        stop = min(start + step, num_time_steps)
 
-        marginals.append(d)
-    
-    return marginals
-    
-    
-def Viterbi(observations):
+        alphas = [checkpoints[seg]]
+        for i in range(start, stop - 1):
+            emmisProb = model.getEmissionProb( observations[i] )
+            alpha = model.A.forward(emmisProb * alphas[-1])
+            alphas.append(alpha / alpha.sum())
+        checkpoints[seg] = None
+
+        for i in reversed(range(start, stop)):
+            emmisProb = model.getEmissionProb( observations[i] )
+            m = alphas[i - start] * beta * emmisProb
+            marginals[i] = model.toDistribution(m / m.sum())
+            beta = model.A.backward(emmisProb * beta)
+            beta /= beta.sum()
+
+    return marginals, logLikelihood
+
+
+def Viterbi(observations, model=None):
     """
     Input
     -----
     observations: a list of observations, one per hidden state
-        (a missing observation is encoded as None)
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
 
     Output
     ------
@@ -228,134 +1559,627 @@ def Viterbi(observations):
     estimated_hidden_states = [] # remove this
     
         
-    sDict = ValToIndex(all_possible_hidden_states)
-    oDict = ValToIndex(all_possible_observed_states)
-    A = TransitionMatrix(sDict).getTransitionMatrix()
-    B = EmissionMatrx( sDict, oDict).getEmissionMatrix()
-    np.place(A, A == 0, 10**-20 )
-    np.place(B, B == 0, 10**-20 )
-    A = -np.log2(A)
-    B = -np.log2(B)
+    if model is None:
+        model = getModel()
+    A = model.A
     
     
-    N = len(all_possible_hidden_states)
-    prior = DMatrix( prior_distribution, N, sDict)
+    N = model.N
     forward_messages = np.zeros( (N,num_time_steps)  )
     back_pointers = np.zeros( (N,num_time_steps), int  )
-    P = prior.getMatrix()
-    np.place(P, P == 0, 10**-20 )
-    forward_messages[:,0] = -np.log2(P)
+    forward_messages[:,0] = model.priorCost
 
     for i in  range(num_time_steps -1 ):
         prevMsg = forward_messages[:,i]
-        emmisProb = getEmissionProb( observations[i], B, oDict, True )
+        emmisProb = model.getEmissionProb( observations[i], True )
         w = prevMsg + emmisProb
-        v = A.T + w
-        forward_messages[:,i+1] = v.min(axis = 1)
-        back_pointers[:,i + 1] = v.argmin(axis = 1)
+        forward_messages[:,i+1], back_pointers[:,i + 1] = A.minPlus(w)
         
      
     m = forward_messages[:, num_time_steps - 1]
-    emmisProb = getEmissionProb( observations[num_time_steps - 1], B, oDict, True )
+    emmisProb = model.getEmissionProb( observations[num_time_steps - 1], True )
     m = m + emmisProb
     t = m.argmin()
     for i in reversed(range(1,num_time_steps)):
-        estimated_hidden_states.append( all_possible_hidden_states[t] )
+        estimated_hidden_states.append( model.states[t] )
         t = back_pointers[t,i]
-    estimated_hidden_states.append( all_possible_hidden_states[t] )    
+    estimated_hidden_states.append( model.states[t] )    
     return list(reversed(estimated_hidden_states))
 
 
-def second_best(observations):
+def viterbi_batch(observations, lengths=None, model=None):
+    """
+    Input
+    -----
+    observations: either a list of observation sequences (each a list of
+        observations, None for a missing one), or a (batch, T) array of
+        observation indices padded with -1
+    lengths: length of every sequence when observations is an index array
+        (defaults to T for all of them)
+    model: compiled HMM to use (defaults to getModel())
+
+    Output
+    ------
+    A list with the MAP estimate of every sequence, each a list of hidden
+    states encoded as tuples (<x>, <y>, <action>)
+    """
+    if model is None:
+        model = getModel()
+    obsIdx, lengths = model.batchObservationIndices(observations, lengths)
+    paths = viterbi_batch_indices(obsIdx, lengths, model)
+    return [[model.states[s] for s in path[:n]]
+            for path, n in zip(paths, lengths)]
+
+
+def viterbi_batch_indices(obsIdx, lengths, model):
+    # Batched Viterbi on index arrays. Only the (at most K) feasible
+    # predecessors of every state are compared, and the back pointers are
+    # kept as uint16/uint32. Returns a (batch, T) array of state indices,
+    # valid up to the length of every sequence.
+    batch, num_time_steps = obsIdx.shape
+    paths = np.zeros((batch, num_time_steps), dtype=np.intp)
+    if num_time_steps == 0:
+        return paths
+
+    rows = np.arange(batch)
+    back_pointers = np.empty((num_time_steps, batch, model.N),
+                             dtype=model.backPointerDtype())
+    final = np.empty((batch, model.N))
+    cost = np.tile(model.priorCost, (batch, 1))
+    for i in range(num_time_steps):
+        w = cost + model.getEmissionCosts(obsIdx[:, i])
+        ending = lengths - 1 == i
+        final[ending] = w[ending]
+        if i < num_time_steps - 1:
+            cost, back_pointers[i + 1] = model.A.minPlus(w)
+
+    last = lengths - 1
+    paths[rows, last] = final.argmin(axis=1)
+    for i in reversed(range(1, num_time_steps)):
+        active = i <= last
+        prev = back_pointers[i][rows, paths[:, i]]
+        paths[active, i - 1] = prev[active]
+    return paths
+
+
+class OnlineViterbi:
+    # Streaming MAP decoder. Observations are fed in one at a time with
+    # update(); as soon as the back-pointer chains of all states at the
+    # current time step pass through a single state at some earlier step,
+    # the MAP path up to that step can no longer change, so it is returned
+    # and its back pointers are dropped. Memory is proportional to the
+    # number of uncommitted steps rather than to the length of the stream.
+    def __init__( self, model = None ):
+        self.model = getModel() if model is None else model
+        self.reset()
+
+    def reset( self ):
+        # cost: -log2 score of the best path ending in every state at the
+        # latest time step, emission included
+        self.cost = None
+        # backPointers[k] maps states at time numCommitted + k + 1 to their
+        # best predecessor at time numCommitted + k
+        self.backPointers = collections.deque()
+        # anc[s]: for every state s still alive (finite cost) at the latest
+        # step, the state its best path passes through at time numCommitted,
+        # the oldest step not committed yet
+        self.anc = None
+        self.numCommitted = 0
+        self.numObservations = 0
+
+    def update( self, observation ):
+        # ingests the next observation (tuple, index or None) and returns
+        # the list of newly committed MAP states (possibly empty)
+        emmisCost = self.model.getEmissionProb(observation, True)
+
+        if self.cost is None:
+            cost = self.model.priorCost
+        else:
+            cost, bp = self.model.A.minPlus(self.cost)
+            # not needed if the previous step has already been committed
+            if self.numCommitted < self.numObservations:
+                bp = bp.astype(self.model.backPointerDtype())
+                self.backPointers.append(bp)
+                self.anc = self.anc[bp]
+        if self.numCommitted == self.numObservations:
+            # this step is the oldest one not committed
+            self.anc = np.arange(self.model.N)
+        self.cost = cost + emmisCost
+        # only differences between scores matter; rebase them once in a
+        # while so they do not lose precision on unbounded streams
+        lowest = self.cost.min()
+        if np.isfinite(lowest) and lowest > 10**6:
+            self.cost -= lowest
+        self.numObservations += 1
+        return self._commit()
+
+    def _commit( self ):
+        # the surviving (finite cost) chains have coalesced somewhere iff
+        # they all pass through one state at the oldest pending step; that
+        # is an O(N) check, so a long run without coalescence (e.g. missing
+        # observations) costs no more per step than a short one
+        alive = np.flatnonzero(np.isfinite(self.cost))
+        if len(alive) == 0:
+            return []
+        oldest = self.anc[alive]
+        if (oldest != oldest[0]).any():
+            return []
+
+        # walk the chains back to the latest step where they meet; the
+        # step after it becomes the oldest pending one
+        k = len(self.backPointers)
+        ancestors = alive
+        while (ancestors != ancestors[0]).any():
+            after = ancestors
+            k -= 1
+            ancestors = self.backPointers[k][ancestors]
+        if k < len(self.backPointers):
+            self.anc = np.zeros(self.model.N, dtype=np.intp)
+            self.anc[alive] = after
+
+        # the path is fixed up to time numCommitted + k
+        s = ancestors[0]
+        prefix = [s]
+        for j in reversed(range(k)):
+            s = self.backPointers[j][s]
+            prefix.append(s)
+        for _ in range(min(k + 1, len(self.backPointers))):
+            self.backPointers.popleft()
+        self.numCommitted += k + 1
+        return [self.model.states[s] for s in reversed(prefix)]
+
+    def updateMany( self, observations ):
+        # feeds a block of observations and returns the MAP states committed
+        # while doing so
+        committed = []
+        for observation in observations:
+            committed += self.update(observation)
+        return committed
+
+    def finalize( self ):
+        # at the end of the stream, returns the MAP states of all the steps
+        # that have not been committed yet
+        if self.cost is None or self.numCommitted == self.numObservations:
+            self.reset()
+            return []
+        s = self.cost.argmin()
+        path = [s]
+        for bp in reversed(self.backPointers):
+            s = bp[s]
+            path.append(s)
+        self.reset()
+        return [self.model.states[s] for s in reversed(path)]
+
+
+def second_best(observations, model=None):
     """
     Input
     -----
     observations: a list of observations, one per hidden state
-        (a missing observation is encoded as None)
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
 
     Output
     ------
     A list of esimated hidden states, each encoded as a tuple
-    (<x>, <y>, <action>)
+    (<x>, <y>, <action>). If no second path has non-zero probability, the
+    MAP estimate is returned.
+    """
+    paths = k_best_paths(observations, 2, model)
+    if len(paths) < 2:
+        return Viterbi(observations, model)
+    return paths[1]
+
+
+def k_best_paths(observations, k, model=None):
     """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    k: number of paths to return
+    model: compiled HMM to use (defaults to getModel())
+
+    Output
+    ------
+    The k most likely hidden state sequences, most likely first, each a list
+    of states encoded as tuples (<x>, <y>, <action>). Fewer than k paths are
+    returned if fewer than k have non-zero probability.
+    """
+    if model is None:
+        model = getModel()
+    costs, paths = calcKBestPaths(observations, k, model)
+    return [[model.states[s] for s in path] for path in paths]
+
+
+def calcKBestPaths(observations, k, model):
+    # List Viterbi: for every state we keep the k best partial paths ending
+    # there, sorted by -log2 score. A state's candidates are the k ranks of
+    # each of its (at most K) predecessors, ordered by predecessor index
+    # and then rank; the best k of those K * k are picked with a stable
+    # sort, so a step costs O(N * K * k * log(K * k)). Ties are broken
+    # like in minPlus() and Viterbi() -- lowest predecessor first, and at
+    # the end lowest state (then rank) first -- so the best path is
+    # exactly Viterbi()'s and the second one always differs from it.
+    # Returns the scores and state index paths.
     num_time_steps = len(observations)
-    
-    estimated_hidden_states = [] # remove this
-    
-        
-    sDict = ValToIndex(all_possible_hidden_states)
-    oDict = ValToIndex(all_possible_observed_states)
-    A = TransitionMatrix(sDict).getTransitionMatrix()
-    B = EmissionMatrx( sDict, oDict).getEmissionMatrix()
-    np.place(A, A == 0, 10**-20 )
-    np.place(B, B == 0, 10**-20 )
-    A = -np.log2(A)
-    B = -np.log2(B)
-    
-    
-    N = len(all_possible_hidden_states)
-    prior = DMatrix( prior_distribution, N, sDict)
-    forward_messages_1 = np.zeros( (N,num_time_steps)  )
-    forward_messages_2 = np.zeros( (N,num_time_steps)  )
-    back_pointers_1 = np.zeros( (N,num_time_steps), int  )
-    back_pointers_2 = np.zeros( (N,num_time_steps), int  )
-   # rank_2 =   np.zeros( (N,num_time_steps), int  )  
-    
-    P = prior.getMatrix()
-    np.place(P, P == 0, 10**-20 )
-    forward_messages_1[:,0] = -np.log2(P)
-    forward_messages_2[:,0] = -np.log2(P)
+    if num_time_steps == 0 or k < 1:
+        return np.zeros((0,)), np.zeros((0, num_time_steps), dtype=np.intp)
+
+    A = model.A
+    N, K = A.predIdx.shape
+    rows = np.arange(N)[:, None]
+    # candidate c of state j comes from rank c % k of predecessor c // k
+    candState = np.repeat(A.predIdx, k, axis=1)
+    candRank = np.tile(np.arange(k), K)
+    candCost = np.repeat(A.predCost, k, axis=1)
+
+    back_states = np.zeros((num_time_steps, N, k),
+                           dtype=model.backPointerDtype())
+    back_ranks = np.zeros((num_time_steps, N, k),
+                          dtype=np.uint16 if k <= 2**16 else np.uint32)
+    cost = np.full((N, k), np.inf)
+    cost[:, 0] = model.priorCost
+
+    for i in range(num_time_steps - 1):
+        w = cost + model.getEmissionProb( observations[i], True )[:, None]
+        v = candCost + w[candState, candRank]
+        top = v.argsort(axis=1, kind='stable')[:, :k]
+
+        best = min(k, top.shape[1])
+        cost[:, :best] = v[rows, top]
+        cost[:, best:] = np.inf
+        back_states[i + 1, :, :best] = candState[rows, top]
+        back_ranks[i + 1, :, :best] = candRank[top]
+
+    w = cost + model.getEmissionProb( observations[-1], True )[:, None]
+    # flat index state * k + rank, so a stable sort puts ties in the order
+    # Viterbi()'s argmin would pick them
+    flat = w.ravel()
+    top = flat.argsort(kind='stable')[:k]
+    top = top[np.isfinite(flat[top])]
+
+    paths = np.zeros((len(top), num_time_steps), dtype=np.intp)
+    s, r = np.divmod(top, k)
+    for i in reversed(range(num_time_steps)):
+        paths[:, i] = s
+        if i > 0:
+            s, r = back_states[i, s, r], back_ranks[i, s, r]
+    return flat[top], paths
 
-    for i in  range(num_time_steps -1 ):
-        prevMsg_1 = forward_messages_1[:,i]
-        prevMsg_2 = forward_messages_2[:,i]
-        emmisProb = getEmissionProb( observations[i], B, oDict, True )
-        w_1 = prevMsg_1 + emmisProb
-        v_1 = A.T + w_1
-        forward_messages_1[:,i+1] = v_1.min(axis = 1)
-        back_pointers_1[:,i + 1] = v_1.argmin(axis = 1)
-        
-        w_2 = prevMsg_2 + emmisProb
-        v_2 = A.T + w_2
-        if i == 0:
-            v = v_2.T
-                       
-        else:
-            v = np.concatenate((v_1.T, v_2.T), axis = 0)
-            
-        minIndices = v.argsort(axis = 0)[1,:]
-        back_pointers_2[:,i+1] = minIndices
-        v.sort(axis = 0)
-        forward_messages_2[:,i+1] = v[1,:]
 
-     
-    m = np.concatenate((forward_messages_1[:, num_time_steps - 1], forward_messages_2[:, num_time_steps - 1]))
-    emmisProb = getEmissionProb( observations[num_time_steps - 1], B, oDict, True )
-    m = m + np.concatenate((emmisProb, emmisProb) )
-    t = m.argsort()[1]
-    print(t)
-    for i in reversed(range(1,num_time_steps)):
-        if t >= N:
-            tIndex =  t - N
-            t = back_pointers_2[tIndex,i]
-        else:
-            tIndex = t
-            t = back_pointers_1[tIndex,i]
-        print(t)
-        estimated_hidden_states.append( all_possible_hidden_states[tIndex] )
-        
-    estimated_hidden_states.append( all_possible_hidden_states[t] )    
-    return list(reversed(estimated_hidden_states))
+# -----------------------------------------------------------------------------
+# Beam-pruned approximate inference
+#
+# When the posterior is concentrated, only a few states carry noticeable
+# mass. The beam versions of filtering and Viterbi keep just the states above
+# a threshold (and/or the beam_width best ones) after every step and push
+# only those through the sparse successor lists, so a step costs time in the
+# size of the beam instead of the number of states.
+
+def beam_filter(observations, model=None, threshold=1e-6, beam_width=None,
+                return_log_likelihood=False):
+    """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
+    threshold: after every step, states with a filtered probability below
+        threshold are dropped
+    beam_width: if given, at most this many states are kept per step
+    return_log_likelihood: if True, also return a lower bound on the
+        natural log of P(observations)
 
+    Output
+    ------
+    A list of filtered distributions P(x_i | y_0, ..., y_i), each a
+    robot.Distribution over the states kept at step i, and an array with the
+    probability mass pruned at each step (all zeros means the result is
+    exact). The lower bound is the log-likelihood with the pruned mass left
+    out; it equals the exact value when nothing was pruned.
+    """
+    if model is None:
+        model = getModel()
+    obsIdx = model.observationIndices(observations)
+    A = model.A
+
+    idx = np.flatnonzero(model.prior)
+    p = model.prior[idx]
+    filtered = []
+    pruned = np.zeros(len(obsIdx))
+    logLikelihood = 0.
+    for i, o in enumerate(obsIdx):
+        if i > 0:
+            idx, p = beamForward(A, idx, p)
+        if o >= 0:
+            idx, p = beamEmission(model.B, o, idx, p)
+        scale = p.sum()
+        if scale == 0:
+            raise ValueError("the beam lost every state consistent with "
+                             "observation %d; use a wider beam" % i)
+        logLikelihood += np.log(scale)
+        p = p / scale
+
+        keep = beamKeep(p, threshold, beam_width)
+        pruned[i] = 1. - p[keep].sum()
+        # the pruned mass is not put back, so later scales (and hence the
+        # log-likelihood) stay lower bounds
+        idx, p = idx[keep], p[keep]
+        d = robot.Distribution()
+        for s, q in zip(idx, p / p.sum()):
+            d[model.states[s]] = q
+        filtered.append(d)
 
-    # -------------------------------------------------------------------------
-    # YOUR CODE GOES HERE
-    #
+    if return_log_likelihood:
+        return filtered, pruned, logLikelihood
+    return filtered, pruned
 
 
+def beam_viterbi(observations, model=None, threshold=1e-6, beam_width=None):
+    """
+    Input
+    -----
+    observations: a list of observations, one per hidden state
+        (a missing observation is encoded as None), or an array of
+        observation indices as stored by robot.save_data_binary()
+    model: compiled HMM to use (defaults to getModel())
+    threshold: after every step, partial paths less than threshold times as
+        likely as the best one are dropped
+    beam_width: if given, at most this many partial paths are kept per step
+
+    Output
+    ------
+    A list of estimated hidden states, each encoded as a tuple
+    (<x>, <y>, <action>), and an array with, for every step, how many bits
+    less likely than the best partial path the best pruned one was (+inf
+    where nothing was pruned). Any path through a pruned state was at least
+    2**min(gaps) times less likely than the best at that point, so a large
+    smallest gap means the pruning is unlikely to have changed the result.
+    """
+    if model is None:
+        model = getModel()
+    obsIdx = model.observationIndices(observations)
+    num_time_steps = len(obsIdx)
+    A = model.A
+
+    idx = np.flatnonzero(model.prior)
+    cost = model.priorCost[idx]
+    bp = idx
+    beams = []
+    gaps = np.full(num_time_steps, np.inf)
+    for i, o in enumerate(obsIdx):
+        if i > 0:
+            idx, cost, bp = beamMinPlus(A, idx, cost)
+        if o >= 0:
+            sIdx, sProb = model.B.getSparseColumn(o)
+            _, pos, posS = np.intersect1d(idx, sIdx, assume_unique=True,
+                                          return_indices=True)
+            idx, bp = idx[pos], bp[pos]
+            cost = cost[pos] + careful_log2(sProb[posS])
+        if len(idx) == 0 or np.isinf(cost.min()):
+            raise ValueError("the beam lost every path consistent with "
+                             "observation %d; use a wider beam" % i)
+
+        # relative probability of every partial path w.r.t. the best one
+        keep = beamKeep(np.exp2(cost.min() - cost), threshold, beam_width)
+        if len(keep) < len(idx):
+            gaps[i] = np.delete(cost, keep).min() - cost.min()
+        idx, cost, bp = idx[keep], cost[keep], bp[keep]
+        beams.append((idx, bp))
+
+    estimated_hidden_states = []
+    t = idx[cost.argmin()]
+    for idx, bp in reversed(beams):
+        estimated_hidden_states.append(model.states[t])
+        t = bp[idx.searchsorted(t)]
+    return list(reversed(estimated_hidden_states)), gaps
+
+
+def beamKeep( score, threshold, beamWidth ):
+    # positions (in increasing order) of the entries with score >= threshold,
+    # at most beamWidth of them (the highest); never empty
+    keep = np.flatnonzero(score >= threshold)
+    if beamWidth is not None and len(keep) > beamWidth:
+        keep = keep[np.argpartition(-score[keep], beamWidth - 1)[:beamWidth]]
+        keep.sort()
+    if len(keep) == 0:
+        keep = np.array([score.argmax()])
+    return keep
+
+
+def beamForward( A, idx, p ):
+    # A.T @ v for a vector v that is p at the (sorted) indices idx and zero
+    # elsewhere; returns the sorted support of the result and its values
+    target = A.succIdx[idx].ravel()
+    q = (A.succProb[idx] * p[:, None]).ravel()
+    order = np.argsort(target, kind='stable')
+    target, q = target[order], q[order]
+    support, start = np.unique(target, return_index=True)
+    return support, np.add.reduceat(q, start)
+
+
+def beamMinPlus( A, idx, cost ):
+    # A.minPlus() for costs given at the (sorted) indices idx and +inf
+    # elsewhere; returns the sorted support, the costs there and the best
+    # predecessors. Ties go to the lowest predecessor index, like minPlus()
+    target = A.succIdx[idx].ravel()
+    c = (cost[:, None] + careful_log2(A.succProb[idx])).ravel()
+    source = np.repeat(idx, A.succIdx.shape[1])
+    order = np.lexsort((source, c, target))
+    target, c, source = target[order], c[order], source[order]
+    support, start = np.unique(target, return_index=True)
+    return support, c[start], source[start]
+
+
+def beamEmission( B, obsIndex, idx, p ):
+    # multiplies the sparse vector (idx, p) by B[:, obsIndex], keeping only
+    # the states that can emit the observation
+    sIdx, sProb = B.getSparseColumn(obsIndex)
+    _, pos, posS = np.intersect1d(idx, sIdx, assume_unique=True,
+                                  return_indices=True)
+    return idx[pos], p[pos] * sProb[posS]
+
+
+# -----------------------------------------------------------------------------
+# Learning the model parameters from unlabeled sequences (Baum-Welch)
+#
+
+def baum_welch(sequences, model=None, num_iterations=20, tolerance=1e-6,
+               processes=None):
+    """
+    Input
+    -----
+    sequences: a list of observation sequences (each a list of observations
+        with None for a missing one, or an index array with -1)
+    model: HMM to start from (defaults to getModel()); transitions and
+        emissions that are impossible in it stay impossible
+    num_iterations: maximum number of EM iterations
+    tolerance: stop once the total log-likelihood improves by less than this
+    processes: number of worker processes for the E-step (None or 1 runs it
+        in this process)
+
+    Output
+    ------
+    The learned HMM and the list of total log-likelihoods, one per iteration
+    (each computed under the model that iteration started from)
+    """
+    if model is None:
+        model = getModel()
+    sequences = [model.observationIndices(s) for s in sequences]
+
+    logLikelihoods = []
+    for iteration in range(num_iterations):
+        counts = calcExpectedCountsAll(sequences, model, processes)
+        logLikelihoods.append(counts[-1])
+        model = reestimate(model, *counts[:-1])
+        if len(logLikelihoods) > 1 and \
+           logLikelihoods[-1] - logLikelihoods[-2] < tolerance:
+            break
+    return model, logLikelihoods
+
+
+def calcExpectedCountsAll(sequences, model, processes=None):
+    # E-step over all sequences, summed; runs in a process pool if asked to,
+    # sending the model to every worker once rather than with every task
+    if processes is None or processes <= 1:
+        results = map(lambda s: calcExpectedCounts(s, model), sequences)
+        return _sumCounts(results)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=_setWorkerModel,
+            initargs=(model,)) as executor:
+        chunksize = max(1, len(sequences) // (4 * processes))
+        return _sumCounts(executor.map(_workerExpectedCounts, sequences,
+                                       chunksize=chunksize))
+
+
+_worker_model = None
+
+
+def _setWorkerModel(model):
+    global _worker_model
+    _worker_model = model
+
 
+def _workerExpectedCounts(obsIdx):
+    return calcExpectedCounts(obsIdx, _worker_model)
 
-    return estimated_hidden_states
+
+def _sumCounts(results):
+    total = None
+    for counts in results:
+        if total is None:
+            total = list(counts)
+        else:
+            for i, c in enumerate(counts):
+                total[i] = total[i] + c
+    return tuple(total)
+
+
+def calcExpectedCounts(obsIdx, model):
+    # E-step for one index sequence. Returns the expected counts
+    #   priorCounts  (N,)   of the initial state
+    #   transCounts  (N, K) of every transition, laid out like A.predIdx
+    #   emitCounts   (L, M) of every emission, laid out like B.obsStateIdx
+    #   emitTotals   (N,)   of every state at observed time steps
+    # and the log-likelihood of the sequence.
+    A = model.A
+    N, K = A.predIdx.shape
+    num_time_steps = len(obsIdx)
+    lengths = np.array([num_time_steps])
+
+    E = model.B.getLikelihoods(obsIdx)
+    forward_messages, logScales = calcForwardMessagesBatch(
+        obsIdx[None, :], lengths, model, likelihoods=E[:, None, :])
+    alphaE = forward_messages[:, 0, :] * E
+
+    backward_messages = np.empty((num_time_steps, N))
+    backward_messages[-1] = 1.
+    for i in reversed(range(1, num_time_steps)):
+        beta = A.backward(E[i] * backward_messages[i])
+        backward_messages[i - 1] = beta / beta.sum()
+    betaE = backward_messages * E
+
+    # posteriors of the states, alpha * e * beta normalized per time step
+    gamma = alphaE * backward_messages
+    gamma /= gamma.sum(axis=1, keepdims=True)
+
+    # xi_i(p -> j) = alphaE_i[p] A[p, j] betaE_{i+1}[j] / Z_i; we sum it over
+    # i one predecessor slot at a time, never forming a (T, N, K) array
+    a = alphaE[:-1]
+    w = betaE[1:]
+    w = w / (w * A.forward(a)).sum(axis=1, keepdims=True)
+    transCounts = np.empty((N, K))
+    for k in range(K):
+        transCounts[:, k] = A.predProb[:, k] * \
+            (w * a[:, A.predIdx[:, k]]).sum(axis=0)
+
+    seen = np.flatnonzero(obsIdx >= 0)
+    gammaPadded = np.zeros((num_time_steps, N + 1))
+    gammaPadded[:, :N] = gamma
+    emitCounts = np.zeros(model.B.obsStateIdx.shape)
+    np.add.at(emitCounts, obsIdx[seen],
+              gammaPadded[seen[:, None], model.B.obsStateIdx[obsIdx[seen]]])
+    emitTotals = gamma[seen].sum(axis=0)
+
+    return gamma[0], transCounts, emitCounts, emitTotals, logScales.sum()
+
+
+def reestimate(model, priorCounts, transCounts, emitCounts, emitTotals):
+    # M-step: a new HMM with the same sparsity pattern and states as model;
+    # rows without any expected counts keep their old probabilities
+    A = model.A
+    N, K = A.predIdx.shape
+
+    prior = priorCounts / priorCounts.sum()
+
+    outflow = np.bincount(A.predIdx.ravel(), transCounts.ravel(), N)
+    predProb = np.where(outflow[A.predIdx] > 0,
+                        transCounts / np.maximum(outflow[A.predIdx],
+                                                 np.finfo(float).tiny),
+                        A.predProb)
+    predProb[A.predProb == 0] = 0
+    # the same probabilities in the successor layout
+    succSlot = (A.predIdx[A.succIdx] ==
+                np.arange(N)[:, None, None]).argmax(axis=2)
+    succProb = np.where(A.succProb > 0, predProb[A.succIdx, succSlot], 0.)
+    newA = SparseTransitionMatrix.fromArrays(A.succIdx, succProb,
+                                             A.predIdx, predProb)
+
+    B = model.B
+    totals = np.append(emitTotals, 0.)[B.obsStateIdx]
+    obsStateProb = np.where(totals > 0,
+                            emitCounts / np.maximum(totals,
+                                                    np.finfo(float).tiny),
+                            B.obsStateProb)
+    obsStateProb[B.obsStateProb == 0] = 0
+    newB = SparseEmissionMatrix.fromArrays(B.N, B.obsStateIdx, obsStateProb)
+
+    return HMM(model.vocabulary, model.oDict.vocabulary, newA, newB, prior)
 
 
 # -----------------------------------------------------------------------------
@@ -372,9 +2196,24 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     # deterministic, which may be helpful for debug purposes
     np.random.seed(random_seed)
 
+    # the transition and observation distributions of every state are
+    # frozen into alias tables the first time they are needed
+    transitions = dict()
+    emissions = dict()
+
+    def move(state):
+        if state not in transitions:
+            transitions[state] = transition_model(state).freeze()
+        return transitions[state].sample()
+
+    def observe(state):
+        if state not in emissions:
+            emissions[state] = observation_model(state).freeze()
+        return emissions[state].sample()
+
     # draw initial state and emit an observation
-    initial_state = prior_distribution.sample()
-    initial_observation = observation_model(initial_state).sample()
+    initial_state = prior_distribution.freeze().sample()
+    initial_observation = observe(initial_state)
 
     hidden_states.append(initial_state)
     observations.append(initial_observation)
@@ -382,16 +2221,16 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     for time_step in range(1, num_time_steps):
         # move the robot
         prev_state = hidden_states[-1]
-        new_state = transition_model(prev_state).sample()
+        new_state = move(prev_state)
 
         # maybe emit an observation
         if not make_some_observations_missing:
-            new_observation = observation_model(new_state).sample()
+            new_observation = observe(new_state)
         else:
             if np.random.rand() < .1:  # 0.1 prob. of observation being missing
                 new_observation = None
             else:
-                new_observation = observation_model(new_state).sample()
+                new_observation = observe(new_state)
 
         hidden_states.append(new_state)
         observations.append(new_observation)
@@ -399,6 +2238,166 @@ def generate_data(num_time_steps, make_some_observations_missing=False,
     return hidden_states, observations
 
 
+# -----------------------------------------------------------------------------
+# Decoding whole directories of track files in parallel
+#
+
+class SharedModel:
+    # Places the arrays of a compiled HMM in one shared memory block so that
+    # worker processes can attach to them instead of receiving a pickled
+    # copy. The (picklable) layout is passed to attach() in the workers.
+    # The block holds the matrices in the form they are used in (see
+    # HMM.toSharedArrays()), so attaching copies no tables and builds no
+    # per-state lists or dicts.
+    def __init__( self, model ):
+        arrays = model.toSharedArrays()
+        self.layout = []
+        offset = 0
+        for key, a in arrays.items():
+            offset = -(-offset // 16) * 16
+            self.layout.append((key, a.dtype.str, a.shape, offset))
+            offset += a.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for key, dtype, shape, offset in self.layout:
+            view = np.ndarray(shape, dtype, self.shm.buf, offset)
+            view[...] = arrays[key]
+
+    def getDescriptor( self ):
+        return self.shm.name, self.layout
+
+    def close( self ):
+        self.shm.close()
+        self.shm.unlink()
+
+    @staticmethod
+    def attach( descriptor ):
+        # returns the shared memory block and an HMM whose matrices are views
+        # into it; the block must be kept open while the model is in use
+        name, layout = descriptor
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = {key: np.ndarray(shape, dtype, shm.buf, offset)
+                  for key, dtype, shape, offset in layout}
+        return shm, HMM.fromSharedArrays(arrays)
+
+
+_worker_shm = None
+
+
+def _attachWorkerModel(descriptor):
+    global _worker_shm, _worker_model
+    _worker_shm, _worker_model = SharedModel.attach(descriptor)
+
+
+def decode_file(filename, out_dir, model=None):
+    # runs forward-backward and Viterbi on a file written by robot.save_data
+    # and writes <name>.map.txt (robot.save_hidden_states format) and
+    # <name>.marginals.npy (a (T, N) array over model.states) to out_dir
+    if model is None:
+        model = _worker_model if _worker_model is not None else getModel()
+    hidden_states, observations = robot.load_data(filename)
+    marginals, states = forward_backward_array(observations, model)
+    estimated_states = Viterbi(observations, model)
+
+    name = os.path.basename(filename)
+    robot.save_hidden_states(os.path.join(out_dir, name + '.map.txt'),
+                             estimated_states)
+    np.save(os.path.join(out_dir, name + '.marginals.npy'), marginals)
+    return len(observations)
+
+
+def decode_directory(in_dir, out_dir, workers=None):
+    """
+    Input
+    -----
+    in_dir: directory of track files written by robot.save_data
+    out_dir: directory for the decoded paths and marginals (see
+        decode_file()); created if needed
+    workers: number of worker processes (defaults to the number of CPUs)
+
+    Output
+    ------
+    The total number of time steps decoded. The files are spread over a
+    process pool; the compiled model is shared with the workers through
+    shared memory rather than pickled for every task.
+    """
+    filenames = sorted(os.path.join(in_dir, f) for f in os.listdir(in_dir)
+                       if os.path.isfile(os.path.join(in_dir, f)))
+    os.makedirs(out_dir, exist_ok=True)
+
+    shared = SharedModel(getModel())
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_attachWorkerModel,
+                initargs=(shared.getDescriptor(),)) as executor:
+            futures = [executor.submit(decode_file, f, out_dir)
+                       for f in filenames]
+            return sum(f.result() for f in futures)
+    finally:
+        shared.close()
+
+
+def cumulativeTable( idx, prob ):
+    # cumulative probabilities for inverse-CDF sampling from the padded rows
+    # of a neighbor-index table: the chosen slot is the number of entries
+    # of the row that are <= u. The last non-zero slot of every row is set
+    # to +inf (as are the padding slots after it), so rounding can never
+    # select a padding slot.
+    cum = np.cumsum(prob, axis=1)
+    last = prob.shape[1] - 1 - (prob[:, ::-1] > 0).argmax(axis=1)
+    cum[np.arange(prob.shape[1]) >= last[:, None]] = np.inf
+    return cum
+
+
+def simulate(num_robots, num_time_steps, missing_prob=0., rng=None,
+             model=None):
+    """
+    Input
+    -----
+    num_robots: number of independent robots to simulate in parallel
+    num_time_steps: length of every track
+    missing_prob: probability that an observation (after the first one) is
+        missing, as in generate_data(..., make_some_observations_missing)
+    rng: a np.random.Generator, or a seed for np.random.default_rng()
+    model: HMM to sample from (defaults to getModel())
+
+    Output
+    ------
+    Two (num_robots, num_time_steps) index arrays: hidden state indices
+    into model.states and observation indices into model.observedStates,
+    with robot.MISSING for a missing observation
+    """
+    if model is None:
+        model = getModel()
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng)
+
+    A = model.A
+    transCum = cumulativeTable(A.succIdx, A.succProb)
+    emitIdx, emitProb = model.B.getStateEmissions()
+    emitCum = cumulativeTable(emitIdx, emitProb)
+    priorCum = np.cumsum(model.prior)
+
+    dtype = model.trackDtype()
+    hidden = np.empty((num_robots, num_time_steps), dtype=dtype)
+    observed = np.empty((num_robots, num_time_steps), dtype=dtype)
+    rows = np.arange(num_robots)
+
+    state = np.minimum(priorCum.searchsorted(rng.random(num_robots),
+                                             side='right'), model.N - 1)
+    for t in range(num_time_steps):
+        if t > 0:
+            u = rng.random((num_robots, 1))
+            state = A.succIdx[state, (u >= transCum[state]).sum(axis=1)]
+        u = rng.random((num_robots, 1))
+        observation = emitIdx[state, (u >= emitCum[state]).sum(axis=1)]
+        if t > 0 and missing_prob > 0:
+            observation[rng.random(num_robots) < missing_prob] = robot.MISSING
+
+        hidden[:, t] = state
+        observed[:, t] = observation
+    return hidden, observed
+
+
 # -----------------------------------------------------------------------------
 # Main
 #
@@ -408,19 +2407,43 @@ def main():
     make_some_observations_missing = False
     use_graphics = True
     need_to_generate_data = True
+    batch_dir = None
+    out_dir = None
+    workers = None
 
     # parse command line arguments
     for arg in sys.argv[1:]:
-        if arg == '--missing':
+        if arg.startswith('--batch='):
+            batch_dir = arg[8:]
+        elif arg.startswith('--out='):
+            out_dir = arg[6:]
+        elif arg.startswith('--workers='):
+            workers = int(arg[10:])
+        elif arg == '--missing':
             make_some_observations_missing = True
         elif arg == '--nographics':
             use_graphics = False
         elif arg.startswith('--load='):
             filename = arg[7:]
-            hidden_states, observations = robot.load_data(filename)
+            if filename.endswith('.npy'):
+                hidden_indices, observation_indices = \
+                    robot.load_data_binary(filename)
+                hidden_states = robot.indices_to_hidden_states(hidden_indices)
+                observations = robot.indices_to_observations(observation_indices)
+            else:
+                hidden_states, observations = robot.load_data(filename)
             need_to_generate_data = False
             num_time_steps = len(hidden_states)
 
+    # batch mode: decode every track file in a directory and exit
+    if batch_dir is not None:
+        if out_dir is None:
+            out_dir = os.path.join(batch_dir, 'decoded')
+        print('Decoding %s into %s...' % (batch_dir, out_dir))
+        num_steps = decode_directory(batch_dir, out_dir, workers)
+        print('Decoded %d time steps' % num_steps)
+        return
+
     # if no data is loaded, then generate new data
     if need_to_generate_data:
         num_time_steps = 100
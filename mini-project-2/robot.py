@@ -1,5 +1,9 @@
 # robot.py
 # Coded by George H. Chen (georgehc@mit.edu) -- updated 10/18/2018
+import collections.abc
+import queue
+import threading
+
 import numpy as np
 
 
@@ -10,6 +14,12 @@ import numpy as np
 GRID_WIDTH = 12
 GRID_HEIGHT = 8
 
+# the order in which get_all_hidden_states() lists the actions of a cell
+ACTIONS = ('left', 'right', 'up', 'down', 'stay')
+
+# (dx, dy) of the move that ends with each action, in the order of ACTIONS
+ACTION_SHIFTS = ((-1, 0), (1, 0), (0, -1), (0, 1), (0, 0))
+
 
 # -----------------------------------------------------------------------------
 # Please read!
@@ -55,6 +65,8 @@ class Distribution(dict):
       returns an item with the highest probability, breaking ties arbitrarily
     sample():
       draws a sample from the Distribution
+    freeze():
+      returns a FrozenDistribution for fast repeated sampling
     """
 
     def __missing__(self, key):
@@ -87,6 +99,257 @@ class Distribution(dict):
         rand_idx = np.where(np.random.multinomial(1, probs))[0][0]
         return keys[rand_idx]
 
+    def freeze(self):
+        return FrozenDistribution(self)
+
+
+class FrozenDistribution:
+    """
+    An immutable snapshot of a Distribution that is sampled from with
+    Walker's alias method: building it takes O(n) time once, after which
+    every draw takes O(1) time and a single uniform random number (from
+    np.random, so np.random.seed() applies as for Distribution.sample()).
+
+    Methods
+    -------
+    sample(n=None):
+      draws one sample, or a list of n samples if n is given
+    """
+
+    def __init__(self, distribution):
+        self.keys = []
+        probs = []
+        for key, prob in distribution.items():
+            if prob > 0:
+                self.keys.append(key)
+                probs.append(prob)
+
+        # Vose's construction: split the n scaled probabilities into n
+        # columns of height 1, each holding at most two outcomes
+        n = len(probs)
+        scaled = np.array(probs) * n / sum(probs)
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, n=None):
+        if n is None:
+            u = np.random.random() * len(self.keys)
+            i = int(u)
+            if u - i >= self.prob[i]:
+                i = self.alias[i]
+            return self.keys[i]
+
+        u = np.random.random(n) * len(self.keys)
+        i = u.astype(int)
+        i = np.where(u - i < self.prob[i], i, self.alias[i])
+        return [self.keys[j] for j in i]
+
+
+class StateIndex:
+    """
+    A fixed vocabulary of keys (e.g. all hidden states) and their positions,
+    meant to be shared by many ArrayDistribution objects.
+    """
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class GridStateIndex(StateIndex):
+    """
+    A StateIndex over hidden states (x, y, action), or over observations
+    (x, y) when action is None, given as arrays of coordinates (and indices
+    into ACTIONS). Neither the list of keys nor the dictionary of positions
+    is built: keys is a read-only sequence that makes the tuples on access,
+    and index a read-only mapping that looks positions up in a grid-shaped
+    array (-1 where a key is not in the vocabulary). That array can be
+    passed in if it already exists, e.g. in shared memory.
+    """
+    __slots__ = ('x', 'y', 'action', 'positions')
+
+    def __init__(self, x, y, action=None, positions=None):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.action = None if action is None else np.asarray(action)
+        if positions is None:
+            coords = (self.x, self.y)
+            shape = (int(self.x.max(initial=-1)) + 1,
+                     int(self.y.max(initial=-1)) + 1)
+            if action is not None:
+                coords += (self.action,)
+                shape += (len(ACTIONS),)
+            positions = np.full(shape, -1, dtype=np.int32)
+            positions[coords] = np.arange(len(self.x), dtype=np.int32)
+        self.positions = positions
+        self.keys = _GridKeys(self)
+        self.index = _GridPositions(self)
+
+
+class _GridKeys(collections.abc.Sequence):
+    # GridStateIndex.keys: the i-th key is made from the coordinate arrays
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __len__(self):
+        return len(self.vocabulary.x)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        v = self.vocabulary
+        if v.action is None:
+            return (int(v.x[i]), int(v.y[i]))
+        return (int(v.x[i]), int(v.y[i]), ACTIONS[v.action[i]])
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and \
+            all(a == b for a, b in zip(self, other))
+
+
+class _GridPositions(collections.abc.Mapping):
+    # GridStateIndex.index: key -> position through the positions array
+    _action_index = {action: a for a, action in enumerate(ACTIONS)}
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, key):
+        positions = self.vocabulary.positions
+        try:
+            if self.vocabulary.action is None:
+                x, y = key
+                coords = (int(x), int(y))
+            else:
+                x, y, action = key
+                coords = (int(x), int(y), self._action_index[action])
+        except (TypeError, ValueError, KeyError):
+            raise KeyError(key)
+        if not all(0 <= c < n for c, n in zip(coords, positions.shape)):
+            raise KeyError(key)
+        i = positions[coords]
+        if i < 0:
+            raise KeyError(key)
+        return int(i)
+
+    def __iter__(self):
+        return iter(self.vocabulary.keys)
+
+    def __len__(self):
+        return len(self.vocabulary.keys)
+
+
+class ArrayDistribution:
+    """
+    A Distribution over the keys of a shared StateIndex, stored as a NumPy
+    vector of probabilities (which may be a view into a larger array)
+    instead of a dictionary. It supports the same dict-like reads as
+    Distribution (d[key], keys(), values(), items(), iteration, len, in),
+    with probability 0 for keys outside the vocabulary, and assignment to
+    keys of the vocabulary.
+
+    Methods
+    -------
+    renormalize():
+      scales all the probabilities so that they sum to 1
+    get_mode():
+      returns an item with the highest probability, breaking ties arbitrarily
+    sample(n=None):
+      draws a sample (or a list of n samples) from the distribution
+    entropy():
+      returns the entropy of the distribution in nats
+    to_distribution():
+      returns an equivalent Distribution
+    """
+    __slots__ = ('vocabulary', 'probs', '_frozen')
+
+    def __init__(self, vocabulary, probs=None):
+        self.vocabulary = vocabulary
+        if probs is None:
+            probs = np.zeros(len(vocabulary))
+        self.probs = probs
+        self._frozen = None
+
+    def __getitem__(self, key):
+        i = self.vocabulary.index.get(key)
+        return 0 if i is None else self.probs[i]
+
+    def __setitem__(self, key, prob):
+        self.probs[self.vocabulary.index[key]] = prob
+        self._frozen = None
+
+    def __contains__(self, key):
+        return key in self.vocabulary.index
+
+    def __iter__(self):
+        return iter(self.vocabulary.keys)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __eq__(self, other):
+        if isinstance(other, ArrayDistribution) and \
+           other.vocabulary is self.vocabulary:
+            return bool(np.array_equal(self.probs, other.probs))
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def get(self, key, default=None):
+        i = self.vocabulary.index.get(key)
+        return default if i is None else self.probs[i]
+
+    def keys(self):
+        return self.vocabulary.keys
+
+    def values(self):
+        return self.probs.tolist()
+
+    def items(self):
+        return zip(self.vocabulary.keys, self.probs.tolist())
+
+    def renormalize(self):
+        self.probs /= self.probs.sum()
+        self._frozen = None
+
+    def get_mode(self):
+        return self.vocabulary.keys[int(self.probs.argmax())]
+
+    def sample(self, n=None):
+        # the alias table is built on the first draw and then reused
+        if self._frozen is None:
+            self._frozen = FrozenDistribution(self)
+        return self._frozen.sample(n)
+
+    def entropy(self):
+        p = self.probs[self.probs > 0]
+        return -(p * np.log(p)).sum()
+
+    def to_distribution(self):
+        return Distribution(self.items())
+
 
 # -----------------------------------------------------------------------------
 # Functions specifying the robot model (e.g., listing all possible hidden and
@@ -98,7 +361,7 @@ def get_all_hidden_states():
     all_states = []
     for x in range(GRID_WIDTH):
         for y in range(GRID_HEIGHT):
-            possible_prev_actions = ['left', 'right', 'up', 'down', 'stay']
+            possible_prev_actions = list(ACTIONS)
 
             if x == 0:  # previous action could not have been to go right
                 possible_prev_actions.remove('right')
@@ -185,6 +448,101 @@ def observation_model(state):
     return observed_states
 
 
+# -----------------------------------------------------------------------------
+# The same model as index tables, computed for the whole grid at once
+#
+
+def build_model_tables(width=None, height=None):
+    """
+    Computes the model above for a width x height grid (default: GRID_WIDTH
+    x GRID_HEIGHT) in closed form from the grid geometry, with NumPy array
+    operations instead of calling transition_model() / observation_model()
+    state by state.
+
+    A transition that ends with action c always lands on the cell
+    ACTION_SHIFTS[c] away, so the transition model is described per grid
+    cell by the probability of every (action before, action after) pair;
+    likewise every observation of a state is equally likely, with a
+    probability that only depends on the cell. Returns a dict of arrays,
+    with states numbered as in get_all_hidden_states():
+      state_x, state_y, state_action (N,) int32: the states, actions
+        encoded as indices into ACTIONS
+      moves (M, 2): the (action before, action after) pairs that have a
+        non-zero probability anywhere, in increasing order
+      move_prob (M, W, H): for every such pair (a, c) and cell (x, y), the
+        probability that state (x, y, a) moves to the state with action c
+        in the cell ACTION_SHIFTS[c] away; 0 where (x, y, a) is not a state
+      obs_prob (W, H): the probability of each observation of a state in
+        cell (x, y)
+      prior (N,): initial_distribution() as a vector
+    """
+    W = GRID_WIDTH if width is None else width
+    H = GRID_HEIGHT if height is None else height
+    LEFT, RIGHT, UP, DOWN, STAY = range(5)
+
+    # which (action, x, y) combinations are states
+    x = np.arange(W)[:, None]
+    y = np.arange(H)[None, :]
+    valid = np.ones((5, W, H), dtype=bool)
+    valid[RIGHT] = x > 0
+    valid[LEFT] = x < W - 1
+    valid[DOWN] = y > 0
+    valid[UP] = y < H - 1
+
+    # states are listed cell by cell, actions in the order of ACTIONS
+    by_cell = valid.transpose(1, 2, 0)
+    count = by_cell.sum(axis=2, dtype=np.int32)
+    state_x = np.repeat(np.arange(W, dtype=np.int32), count.sum(axis=1))
+    state_y = np.repeat(np.tile(np.arange(H, dtype=np.int32), W),
+                        count.ravel())
+    state_action = np.broadcast_to(np.arange(5, dtype=np.int32),
+                                   by_cell.shape)[by_cell]
+
+    # whether the move ending with each action stays on the grid
+    inside = {}
+    for action in (UP, DOWN, LEFT, RIGHT):
+        dx, dy = ACTION_SHIFTS[action]
+        inside[action] = (x + dx >= 0) & (x + dx < W) & \
+            (y + dy >= 0) & (y + dy < H)
+
+    probs = {}
+    # from 'stay': stay or any possible move, .2 each before normalizing
+    # (summed in transition_model()'s order so the division is exact)
+    weights = [np.full((W, H), .2)] + \
+        [.2 * inside[action] for action in (UP, DOWN, LEFT, RIGHT)]
+    total = sum(weights)
+    probs[STAY, STAY] = weights[0] / total
+    for action in (UP, DOWN, LEFT, RIGHT):
+        probs[STAY, action] = .2 * inside[action] / total
+    # after a move: stop with .1 or keep going with .9 if possible
+    for action in (UP, DOWN, LEFT, RIGHT):
+        total = .1 + .9 * inside[action]
+        probs[action, STAY] = .1 / total
+        probs[action, action] = .9 * inside[action] / total
+
+    moves = []
+    move_prob = np.empty((len(probs), W, H))
+    for a, c in sorted(probs):
+        np.multiply(probs[a, c], valid[a], out=move_prob[len(moves)])
+        if move_prob[len(moves)].any():
+            moves.append((a, c))
+    moves = np.array(moves, dtype=np.int32).reshape(-1, 2)
+    move_prob = move_prob[:len(moves)]
+
+    # observations: the cell itself and its on-grid neighbors, equally
+    # likely
+    count = np.zeros((W, H))
+    for dx, dy in [(-1, 0), (0, -1), (0, 0), (0, 1), (1, 0)]:
+        count += (x + dx >= 0) & (x + dx < W) & (y + dy >= 0) & (y + dy < H)
+    obs_prob = 1. / count
+
+    prior = np.zeros(len(state_action))
+    prior[state_action == STAY] = 1. / (W * H)
+    return dict(state_x=state_x, state_y=state_y, state_action=state_action,
+                moves=moves, move_prob=move_prob, obs_prob=obs_prob,
+                prior=prior)
+
+
 # -----------------------------------------------------------------------------
 # Saving and loading lists of hidden states and observations
 #
@@ -239,6 +597,79 @@ def load_data(filename):
     return hidden_states, observations
 
 
+def iter_load_data(filename, chunk_size=10000):
+    # like load_data(), but reads the file lazily and yields
+    # (hidden_states, observations) blocks of at most chunk_size time steps,
+    # so memory does not grow with the length of the file
+    hidden_states = []
+    observations = []
+    with open(filename, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+
+            hidden_states.append((int(parts[0]), int(parts[1]), parts[2]))
+            if parts[3] == 'missing':
+                observations.append(None)
+            elif len(parts) == 5:
+                observations.append((int(parts[3]), int(parts[4])))
+
+            if len(hidden_states) == chunk_size:
+                yield hidden_states, observations
+                hidden_states = []
+                observations = []
+
+    if hidden_states:
+        yield hidden_states, observations
+
+
+def prefetch(blocks, depth=2):
+    # iterates over blocks (e.g. from iter_load_data()) while a background
+    # thread reads up to depth blocks ahead, overlapping I/O with whatever
+    # the caller does with each block. If the caller stops early (break,
+    # an exception, or dropping the generator) the reader is told to stop
+    # and the queue is drained until it has, and blocks is closed if it
+    # can be, so no thread is left blocked on a full queue holding a file
+    # or memory map open
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    break
+                buffer.put(block)
+            else:
+                buffer.put(done)
+        except BaseException as e:
+            buffer.put(e)
+        finally:
+            close = getattr(blocks, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = buffer.get()
+            if block is done:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 def save_hidden_states(filename, hidden_states):
     # saves a list of hidden states to a text file where each line says:
     # <x> <y> <action>
@@ -254,9 +685,8 @@ def load_hidden_states(filename):
 
     hidden_states = []
     for line in f.readlines():
-        line = line.strip()
-        if len(line) == 3:
-            parts = line.split()
+        parts = line.split()
+        if len(parts) == 3:
             x = int(parts[0])
             y = int(parts[1])
             action = parts[2]
@@ -285,14 +715,97 @@ def load_observations(filename):
 
     observations = []
     for line in f.readlines():
-        line = line.strip()
-        if len(line) == 1 and line == 'missing':
+        parts = line.split()
+        if parts == ['missing']:
             observations.append(None)
-        elif len(line) == 2:
-            parts = line.split()
+        elif len(parts) == 2:
             x = int(parts[0])
             y = int(parts[1])
             observations.append((x, y))
 
     f.close()
     return observations
+
+
+# -----------------------------------------------------------------------------
+# Binary track format
+#
+# A track is stored as a (2, T) integer array in a .npy file: row 0 holds the
+# index of each hidden state in get_all_hidden_states() and row 1 the index
+# of each observation in get_all_observed_states(), with MISSING for a
+# missing observation. Each row is contiguous, the dtype is int16 when the
+# indices fit (int32 otherwise), and the file can be memory-mapped.
+#
+
+MISSING = -1
+
+
+def track_dtype():
+    # smallest signed integer type that can hold every state index
+    largest = max(len(get_all_hidden_states()), len(get_all_observed_states()))
+    if largest <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+def hidden_states_to_indices(hidden_states):
+    index = {s: i for i, s in enumerate(get_all_hidden_states())}
+    return np.array([index[s] for s in hidden_states], dtype=track_dtype())
+
+
+def observations_to_indices(observations):
+    index = {o: i for i, o in enumerate(get_all_observed_states())}
+    return np.array([MISSING if o is None else index[o]
+                     for o in observations], dtype=track_dtype())
+
+
+def indices_to_hidden_states(indices):
+    all_states = get_all_hidden_states()
+    return [all_states[i] for i in indices]
+
+
+def indices_to_observations(indices):
+    all_observed_states = get_all_observed_states()
+    return [None if i == MISSING else all_observed_states[i]
+            for i in indices]
+
+
+def save_data_binary(filename, hidden_indices, observation_indices):
+    # saves index arrays of hidden states and observations as a (2, T) .npy
+    assert len(hidden_indices) == len(observation_indices)
+    track = np.empty((2, len(hidden_indices)), dtype=track_dtype())
+    track[0] = hidden_indices
+    track[1] = observation_indices
+    np.save(filename, track)
+
+
+def load_data_binary(filename, mmap=False):
+    # loads the index arrays saved by save_data_binary(); with mmap=True they
+    # are read-only views of a memory-mapped file
+    track = np.load(filename, mmap_mode='r' if mmap else None)
+    return track[0], track[1]
+
+
+def iter_load_data_binary(filename, chunk_size=100000):
+    # yields (hidden_indices, observation_indices) blocks of at most
+    # chunk_size time steps from a memory-mapped binary track; only the
+    # pages of the current block need to be in memory
+    hidden_indices, observation_indices = load_data_binary(filename,
+                                                           mmap=True)
+    for start in range(0, len(hidden_indices), chunk_size):
+        yield (np.array(hidden_indices[start:start + chunk_size]),
+               np.array(observation_indices[start:start + chunk_size]))
+
+
+def convert_text_to_binary(text_filename, binary_filename):
+    # converts a file written by save_data() to the binary format
+    hidden_states, observations = load_data(text_filename)
+    save_data_binary(binary_filename, hidden_states_to_indices(hidden_states),
+                     observations_to_indices(observations))
+
+
+def convert_binary_to_text(binary_filename, text_filename):
+    # converts a file written by save_data_binary() to the text format
+    hidden_indices, observation_indices = load_data_binary(binary_filename)
+    save_data(text_filename, indices_to_hidden_states(hidden_indices),
+              indices_to_observations(observation_indices))
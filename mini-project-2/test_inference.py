@@ -0,0 +1,190 @@
+# Regression tests for the numerically subtle parts of inference.py, checked
+# against brute-force enumeration of every hidden state sequence on tiny
+# grids. Run with: python -m pytest test_inference.py
+import itertools
+import os
+
+import numpy as np
+
+import inference
+import robot
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def tiny_model(width=2, height=2):
+    return inference.HMM.fromTables(robot.build_model_tables(width, height))
+
+
+def tiny_observations(model, num_time_steps=5, seed=0):
+    # an observation index sequence with some missing entries
+    obsIdx = inference.simulate(1, num_time_steps, .3, seed, model)[1][0]
+    return obsIdx.astype(np.intp)
+
+
+def enumerate_paths(model, obsIdx):
+    # every state sequence and its joint probability with the observations
+    A = model.A.getTransitionMatrix()
+    E = model.B.getLikelihoods(obsIdx)
+    paths = np.array(list(itertools.product(range(model.N),
+                                            repeat=len(obsIdx))))
+    p = model.prior[paths[:, 0]] * E[0, paths[:, 0]]
+    for i in range(1, len(obsIdx)):
+        p = p * A[paths[:, i - 1], paths[:, i]] * E[i, paths[:, i]]
+    return paths, p
+
+
+def path_cost(paths, p, path):
+    # -log2 probability of one path, looked up in the enumeration
+    return -np.log2(p[(paths == path).all(axis=1)][0])
+
+
+def test_k_best_paths_match_brute_force():
+    model = tiny_model()
+    for seed in range(3):
+        obsIdx = tiny_observations(model, seed=seed)
+        paths, p = enumerate_paths(model, obsIdx)
+        expected = np.sort(-np.log2(p[p > 0]))
+
+        k = 8
+        costs, best = inference.calcKBestPaths(obsIdx, k, model)
+        assert len(costs) == min(k, len(expected))
+        assert np.allclose(costs, expected[:len(costs)])
+        # every path is distinct and scored correctly
+        assert len({tuple(path) for path in best}) == len(best)
+        for cost, path in zip(costs, best):
+            assert np.isclose(path_cost(paths, p, path), cost)
+
+
+def score(model, obsIdx, path):
+    # -log2 joint probability of a path of state tuples
+    s = [model.vocabulary.index[state] for state in path]
+    A = model.A.getTransitionMatrix()
+    E = model.B.getLikelihoods(obsIdx)
+    with np.errstate(divide='ignore'):
+        return -(np.log2(model.prior[s[0]]) +
+                 np.log2(A[s[:-1], s[1:]]).sum() +
+                 np.log2(E[np.arange(len(s)), s]).sum())
+
+
+def test_k_best_paths_start_with_viterbi():
+    model = tiny_model(3, 2)
+    for seed in range(3):
+        obsIdx = tiny_observations(model, 12, seed)
+        costs, _ = inference.calcKBestPaths(obsIdx, 3, model)
+        paths = inference.k_best_paths(obsIdx, 3, model)
+        assert np.allclose([score(model, obsIdx, path) for path in paths],
+                           costs)
+        # ties are broken like Viterbi() breaks them, so the best path is
+        # Viterbi()'s own and the second best differs from it
+        viterbi = inference.Viterbi(obsIdx, model)
+        assert paths[0] == viterbi
+        second = inference.second_best(obsIdx, model)
+        assert second == paths[1] and second != viterbi
+        assert np.isclose(score(model, obsIdx, second), costs[1])
+
+
+def test_second_best_differs_from_viterbi_on_ties():
+    # tracks whose two best paths have the same score: test_missing.txt
+    # (three paths tie) and generate_data() tracks with seeds known to tie
+    model = inference.getModel()
+    tracks = [robot.load_data(os.path.join(HERE, 'test_missing.txt'))[1]]
+    tracks += [inference.generate_data(100, True, seed)[1]
+               for seed in (0, 1, 2, 6)]
+    for observations in tracks:
+        costs, _ = inference.calcKBestPaths(observations, 2, model)
+        assert costs[0] == costs[1]
+        viterbi = inference.Viterbi(observations, model)
+        assert inference.k_best_paths(observations, 2, model)[0] == viterbi
+        assert inference.second_best(observations, model) != viterbi
+
+
+def test_second_best_without_a_second_path():
+    # a single cell has a single state, so there is only one path
+    model = tiny_model(1, 1)
+    observations = [(0, 0), None, (0, 0)]
+    assert len(inference.k_best_paths(observations, 2, model)) == 1
+    assert inference.second_best(observations, model) == \
+        [(0, 0, 'stay')] * 3
+
+
+def test_online_viterbi_matches_viterbi_across_dropouts():
+    # a stream with a long run of missing observations in the middle: the
+    # states committed on the way plus finalize() must score like the MAP
+    # path, and once observations resume the chains must coalesce again
+    # so the pending back pointers stay few
+    for width, height in [(12, 8), (1, 5)]:
+        model = tiny_model(width, height)
+        for seed in range(2):
+            obsIdx = np.concatenate([
+                inference.simulate(1, 100, .1, seed, model)[1][0],
+                np.full(300, robot.MISSING),
+                inference.simulate(1, 200, .1, seed + 10, model)[1][0]])
+            decoder = inference.OnlineViterbi(model)
+            committed = []
+            pending = []
+            for o in obsIdx:
+                committed += decoder.update(o)
+                pending.append(len(decoder.backPointers))
+                assert len(committed) == decoder.numCommitted
+                assert pending[-1] < decoder.numObservations - \
+                    decoder.numCommitted + 1
+            path = committed + decoder.finalize()
+
+            assert len(path) == len(obsIdx)
+            assert np.isclose(
+                score(model, obsIdx, path),
+                score(model, obsIdx, inference.Viterbi(obsIdx, model)))
+            # the dropout itself stays pending, the steps after it do not
+            assert max(pending[100:400]) >= 250
+            assert max(pending[450:]) < 50
+
+
+def test_expected_counts_match_brute_force():
+    model = tiny_model()
+    obsIdx = tiny_observations(model, seed=1)
+    paths, p = enumerate_paths(model, obsIdx)
+    posterior = p / p.sum()
+
+    priorCounts, transCounts, emitCounts, emitTotals, logLikelihood = \
+        inference.calcExpectedCounts(obsIdx, model)
+
+    assert np.isclose(logLikelihood, np.log(p.sum()))
+    assert np.allclose(priorCounts,
+                       np.bincount(paths[:, 0], posterior, model.N))
+
+    expected = np.zeros((model.N, model.N))
+    for i in range(1, len(obsIdx)):
+        np.add.at(expected, (paths[:, i - 1], paths[:, i]), posterior)
+    A = model.A
+    # transCounts[j, k] counts the moves predIdx[j, k] -> j
+    targets = np.arange(model.N)[:, None]
+    assert np.allclose(transCounts, np.where(A.predProb > 0,
+                                             expected[A.predIdx, targets], 0))
+
+    seen = np.flatnonzero(obsIdx >= 0)
+    assert np.allclose(emitTotals,
+                       np.bincount(paths[:, seen].ravel(),
+                                   np.repeat(posterior, len(seen)), model.N))
+    assert np.isclose(emitCounts.sum(), len(seen))
+
+
+def test_baum_welch_increases_likelihood():
+    model = tiny_model(3, 2)
+    sequences = [tiny_observations(model, 20, seed) for seed in range(4)]
+    learned, logLikelihoods = inference.baum_welch(
+        sequences, model, num_iterations=6, tolerance=-np.inf)
+
+    assert len(logLikelihoods) == 6
+    assert np.isclose(logLikelihoods[0],
+                      sum(inference.log_likelihood(s, model)
+                          for s in sequences))
+    assert np.all(np.diff(logLikelihoods) >= -1e-9)
+
+    # still distributions, with nothing impossible made possible
+    A = learned.A.getTransitionMatrix()
+    assert np.allclose(A.sum(axis=1), 1)
+    assert np.all(A[model.A.getTransitionMatrix() == 0] == 0)
+    assert np.isclose(learned.prior.sum(), 1)
+    emitIdx, emitProb = learned.B.getStateEmissions()
+    assert np.allclose(emitProb.sum(axis=1), 1)